@@ -1,21 +1,31 @@
 import argparse
 import asyncio
 import logging
+import os
+import signal
 import sys
-from typing import Any, Mapping, Sequence
+from datetime import datetime
+from typing import Any, Sequence
 
-import slack
-
-from .runner import PePuRunner
-from .settings import initialize_settings
-from .slack import get_rtm_client
+from .settings import get_settings, initialize_settings
 
 LOG = logging.getLogger(__name__)
 
 
 def main(argv: Sequence[str] = sys.argv) -> None:
     args = parse_args(argv)
+    if args.startup_report:
+        print_startup_report(args.config_file)
+        return
+    if args.command == 'load-test':
+        sys.exit(run_load_test(args))
     initialize_settings(args.config_file)
+    if args.command == 'export':
+        export_storage(args)
+        return
+    if args.command == 'convert':
+        convert_storage(args)
+        return
     logging.basicConfig(level=logging.INFO)
     run_pepubot()
 
@@ -25,28 +35,135 @@ def parse_args(argv: Sequence[str]) -> Any:
     parser.add_argument(
         '--config-file', '-c', default='pepubot.conf',
         help='Path to configuration file')
+    parser.add_argument(
+        '--startup-report', action='store_true',
+        help='Report the time spent in startup and exit')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='Run the bot (default)')
+    export_parser = subparsers.add_parser(
+        'export', help='Export the storage history to standard output')
+    export_parser.add_argument(
+        '--format', '-f', choices=['ndjson', 'csv'], default='ndjson',
+        help='Output format')
+    export_parser.add_argument(
+        '--item', '-i', action='append', dest='items', metavar='NAME',
+        help='Export only the given item (may be given several times)')
+    export_parser.add_argument(
+        '--since', type=datetime.fromisoformat, metavar='TIME',
+        help='Export only versions stored at or after given ISO 8601 time')
+    export_parser.add_argument(
+        '--until', type=datetime.fromisoformat, metavar='TIME',
+        help='Export only versions stored before given ISO 8601 time')
+    export_parser.add_argument(
+        '--storage-file', '-s',
+        help='Path to the storage file (default: from the configuration)')
+    convert_parser = subparsers.add_parser(
+        'convert', help='Convert the storage file to another format')
+    convert_parser.add_argument(
+        '--format', '-f', required=True,
+        choices=['json', 'compact-json', 'indexed', 'snapshot'],
+        help='Format to convert to')
+    convert_parser.add_argument(
+        '--storage-file', '-s',
+        help='Path to the storage file (default: from the configuration)')
+    convert_parser.add_argument(
+        '--output', '-o', metavar='FILE',
+        help='Path to write the converted file to (default: in place)')
+    load_test_parser = subparsers.add_parser(
+        'load-test', help=(
+            'Run a PePu round with simulated users against a fake Slack '
+            'server and report the results'))
+    load_test_parser.add_argument(
+        '--users', type=int, default=1000,
+        help='Number of simulated users posting media')
+    load_test_parser.add_argument(
+        '--posts-per-user', type=int, default=2,
+        help='Number of media messages posted by each user')
+    load_test_parser.add_argument(
+        '--latency', type=float, default=0.0, metavar='SECONDS',
+        help='Latency of the fake Slack Web API')
+    load_test_parser.add_argument(
+        '--error-rate', type=float, default=0.0, metavar='FRACTION',
+        help='Fraction of failing reactions.add and users.info calls')
+    load_test_parser.add_argument(
+        '--rate-limit', type=int, default=0, metavar='REQUESTS',
+        help='Allowed requests per second per API method (0 = no limit)')
+    load_test_parser.add_argument(
+        '--seed', type=int, help='Seed for the random generators')
     return parser.parse_args(argv[1:])
 
 
-def run_pepubot() -> None:
-    LOG.info('Initializing the Slack RTM client')
-    slack_rtm_client = get_rtm_client()
+def print_startup_report(config_file: str) -> None:
+    from .startup import measure_startup, print_startup_report
+
+    print_startup_report(measure_startup(config_file), sys.stdout)
+
+
+def export_storage(args: Any) -> None:
+    from .export import WRITERS, iter_records
+    from .times import make_aware
+
+    records = iter_records(
+        args.storage_file or get_settings().STORAGE_FILE,
+        items=args.items,
+        since=make_aware(args.since) if args.since else None,
+        until=make_aware(args.until) if args.until else None)
+    try:
+        WRITERS[args.format](records, sys.stdout)
+        sys.stdout.flush()
+    except BrokenPipeError:  # E.g. piped to head
+        # Avoid another BrokenPipeError when Python flushes on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def convert_storage(args: Any) -> None:
+    from .storage import convert_file
 
-    LOG.info('Binging our event handler')
-    slack_rtm_client.on(event='message', callback=handle_new_message)
+    source = args.storage_file or get_settings().STORAGE_FILE
+    asyncio.get_event_loop().run_until_complete(
+        convert_file(source, args.output or source, args.format))
+
+
+def run_load_test(args: Any) -> int:
+    import tempfile
+    from .load_test import print_report, run_load_test
+
+    with tempfile.TemporaryDirectory(prefix='pepubot-load-test-') as tmpdir:
+        report = asyncio.get_event_loop().run_until_complete(run_load_test(
+            tmpdir, users=args.users, posts_per_user=args.posts_per_user,
+            latency=args.latency, error_rate=args.error_rate,
+            rate_limit=args.rate_limit, seed=args.seed))
+    print_report(report, sys.stdout)
+    return 1 if report.violations else 0
+
+
+def run_pepubot() -> None:
+    from .workspace import create_http_session, create_workspaces
 
-    LOG.info('Starting the Slack RTM session in an event loop')
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(slack_rtm_client.start())
+    session = loop.run_until_complete(create_http_session())
+
+    LOG.info('Initializing the Slack workspaces')
+    workspaces = loop.run_until_complete(
+        create_workspaces(get_settings(), session))
+
+    LOG.info('Starting the Slack RTM sessions in an event loop')
+    futures = [x.start() for x in workspaces]
 
+    def stop_workspaces() -> None:
+        for workspace in workspaces:
+            workspace.stop()
 
-async def handle_new_message(
-        *,
-        data: Mapping[str, Any],
-        web_client: slack.WebClient,
-        **kwargs: object,
-) -> None:
-    await PePuRunner(web_client).feed_message(data)
+    for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+        # Replace the handlers of the RTM clients, since each of them
+        # would only stop itself
+        loop.add_signal_handler(signum, stop_workspaces)
+    try:
+        loop.run_until_complete(asyncio.gather(*futures))
+    finally:
+        for workspace in workspaces:
+            loop.run_until_complete(workspace.drain())
+        loop.run_until_complete(session.close())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+"""
+Caching wrapper for the Slack Web API client.
+
+Identical concurrent calls of the read methods are coalesced into a
+single request, and their successful responses are memoized for a
+method specific time.  Expired responses are pruned and the number
+of responses cached per method is limited.  Permalinks of messages
+are built locally from the team URL when it is known.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import (TYPE_CHECKING, Any, Dict, Mapping, NamedTuple, Optional,
+                    Tuple)
+
+if TYPE_CHECKING:
+    import slack
+
+LOG = logging.getLogger(__name__)
+
+#: Time to live (in seconds) of the cached responses per method
+DEFAULT_TTLS: Mapping[str, float] = {
+    'auth_test': 24 * 60 * 60,
+    'chat_getPermalink': 24 * 60 * 60,
+    'users_info': 60 * 60,
+}
+
+#: Maximum number of cached responses per method
+DEFAULT_MAX_SIZE = 10000
+
+_CacheKey = Tuple[str, Tuple[Tuple[str, Any], ...]]
+_CacheEntry = Tuple[float, Any]  # expiry time and the response
+
+
+class CacheStats(NamedTuple):
+    hits: int  # served from the cache
+    coalesced: int  # joined an identical in-flight request
+    misses: int  # sent a request
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.coalesced + self.misses
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (f'hit rate {self.hit_rate:.1%} ({self.hits} hits, '
+                f'{self.coalesced} coalesced, {self.misses} misses)')
+
+
+class LocalResponse(NamedTuple):
+    """
+    Response built locally without calling the Web API.
+    """
+    data: Dict[str, Any]
+
+
+class CachingWebClient:
+    def __init__(
+            self,
+            client: 'slack.WebClient',
+            ttls: Mapping[str, float] = DEFAULT_TTLS,
+            max_size: int = DEFAULT_MAX_SIZE,
+    ) -> None:
+        self.client = client
+        self.ttls = ttls
+        self.max_size = max_size
+        # Per method in the order of expiry, since the TTL is per method
+        self._caches: Dict[str, 'OrderedDict[_CacheKey, _CacheEntry]'] = {
+            method: OrderedDict() for method in ttls}
+        self._in_flight: Dict[_CacheKey, 'asyncio.Future[Any]'] = {}
+        self._stats: Dict[str, CacheStats] = {}
+        self._team_url: Optional[str] = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name in self.ttls:
+            return lambda **kwargs: self._call(name, kwargs)
+        return getattr(self.client, name)
+
+    def get_stats(self) -> Dict[str, CacheStats]:
+        return dict(self._stats)
+
+    def get_cache_size(self) -> int:
+        return sum(len(x) for x in self._caches.values())
+
+    async def chat_getPermalink(self, **kwargs: Any) -> Any:
+        team_url = await self._get_team_url()
+        channel = kwargs.get('channel')
+        ts = kwargs.get('message_ts')
+        if team_url and channel and ts:
+            self._count('chat_getPermalink', hits=1)
+            permalink = f'{team_url}archives/{channel}/p{ts.replace(".", "")}'
+            return LocalResponse(
+                {'ok': True, 'channel': channel, 'permalink': permalink})
+        return await self._call('chat_getPermalink', kwargs)
+
+    async def _get_team_url(self) -> Optional[str]:
+        if self._team_url is None and 'auth_test' in self.ttls:
+            try:
+                response = await self._call('auth_test', {})
+            except Exception as error:
+                LOG.warning('Cannot get the team URL: %s', error)
+                return None
+            url = response.data.get('url')
+            if isinstance(url, str) and url.startswith('https://'):
+                self._team_url = url if url.endswith('/') else url + '/'
+        return self._team_url
+
+    async def _call(self, method: str, kwargs: Mapping[str, Any]) -> Any:
+        if method not in self.ttls:  # Not cached
+            return await getattr(self.client, method)(**kwargs)
+        key: _CacheKey = (method, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        cache = self._caches[method]
+        cached = cache.get(key)
+        if cached and cached[0] > now:
+            self._count(method, hits=1)
+            return cached[1]
+        in_flight = self._in_flight.get(key)
+        if in_flight:
+            self._count(method, coalesced=1)
+            return await asyncio.shield(in_flight)
+        self._count(method, misses=1)
+        future = asyncio.ensure_future(getattr(self.client, method)(**kwargs))
+        self._in_flight[key] = future
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            del self._in_flight[key]
+        self._store(cache, key, response, self.ttls[method])
+        return response
+
+    def _store(
+            self,
+            cache: 'OrderedDict[_CacheKey, _CacheEntry]',
+            key: _CacheKey,
+            response: Any,
+            ttl: float,
+    ) -> None:
+        now = time.monotonic()
+        cache.pop(key, None)
+        cache[key] = (now + ttl, response)
+        while cache:  # Prune the expired and the oldest over the limit
+            (expires_at, _response) = next(iter(cache.values()))
+            if expires_at > now and len(cache) <= self.max_size:
+                break
+            cache.popitem(last=False)
+
+    def _count(
+            self,
+            method: str,
+            *,
+            hits: int = 0,
+            coalesced: int = 0,
+            misses: int = 0,
+    ) -> None:
+        old = self._stats.get(method, CacheStats(0, 0, 0))
+        self._stats[method] = CacheStats(
+            old.hits + hits, old.coalesced + coalesced, old.misses + misses)
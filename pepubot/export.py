@@ -0,0 +1,100 @@
+"""
+Export of the storage history.
+
+Every version of every stored item is exported as a record.  In
+addition every ticket of every version of the lottery box is exported
+as a record of its own.  The records are streamed from the storage
+file one at a time, so exporting does not need more memory for large
+histories than for small ones.
+"""
+import csv
+import json
+from datetime import datetime, timezone
+from typing import (Callable, Collection, Dict, Iterable, Iterator, Optional,
+                    TextIO, Union)
+
+from .lottery_box import iter_tickets
+from .storage import iter_file_versions
+
+Record = Dict[str, Union[str, int]]
+
+FIELDS = [
+    'record_type',
+    'item',
+    'version_timestamp',
+    'version_time',
+    'value',
+    'position',
+    'ticket',
+    'ticket_created_at',
+    'channel',
+    'message_ts',
+    'user_id',
+    'username',
+]
+
+
+def iter_records(
+        filename: str,
+        *,
+        items: Optional[Collection[str]] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+) -> Iterator[Record]:
+    """
+    Iterate the records of the storage file, optionally filtered.
+
+    The version and ticket records are filtered by the item name and by
+    the time of the version: since is inclusive and until is exclusive.
+    """
+    since_ns = _to_ns(since) if since else None
+    until_ns = _to_ns(until) if until else None
+    for (name, version) in iter_file_versions(filename):
+        if items is not None and name not in items:
+            continue
+        if since_ns is not None and version.timestamp < since_ns:
+            continue
+        if until_ns is not None and version.timestamp >= until_ns:
+            continue
+        version_record: Record = {
+            'record_type': 'version',
+            'item': name,
+            'version_timestamp': version.timestamp,
+            'version_time': datetime.fromtimestamp(
+                version.timestamp / 1e9, timezone.utc).isoformat(),
+        }
+        yield dict(version_record, value='\n'.join(version.value))
+        if name == 'lottery_box':
+            tickets = iter_tickets(version.value)
+            for (position, ticket) in enumerate(tickets, 1):
+                yield dict(
+                    version_record,
+                    record_type='ticket',
+                    position=position,
+                    ticket=ticket.id,
+                    ticket_created_at=ticket.created_at.isoformat(),
+                    channel=ticket.source_message_channel,
+                    message_ts=ticket.source_message_ts,
+                    user_id=ticket.owner_user_id,
+                    username=ticket.owner_username)
+
+
+def write_ndjson(records: Iterable[Record], output: TextIO) -> None:
+    for record in records:
+        output.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def write_csv(records: Iterable[Record], output: TextIO) -> None:
+    writer = csv.DictWriter(output, FIELDS, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(records)
+
+
+WRITERS: Dict[str, Callable[[Iterable[Record], TextIO], None]] = {
+    'ndjson': write_ndjson,
+    'csv': write_csv,
+}
+
+
+def _to_ns(time: datetime) -> int:
+    return int(time.timestamp()) * 10**9 + time.microsecond * 1000
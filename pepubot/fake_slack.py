@@ -0,0 +1,216 @@
+"""
+Fake Slack server for load testing.
+
+Implements the Web API methods used by PePuBot and an RTM websocket,
+which the events can be sent to the bot through.  Responses of the
+Web API can be delayed, failed or rate limited to simulate a real
+server under load.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import socket
+import time
+from collections import Counter, deque
+from typing import (Any, Callable, Deque, Dict, List, Mapping, Optional,
+                    Sequence)
+
+from aiohttp import WSMsgType, web
+
+DEFAULT_ERROR_METHODS = ['reactions.add', 'users.info']
+
+JsonDict = Dict[str, Any]
+
+
+class FakeSlackServer:
+    def __init__(
+            self,
+            *,
+            latency: float = 0.0,
+            error_rate: float = 0.0,
+            error_methods: Sequence[str] = DEFAULT_ERROR_METHODS,
+            rate_limit: int = 0,
+            team_domain: str = 'fake-team',
+            seed: Optional[int] = None,
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_methods = error_methods
+        self.rate_limit = rate_limit  # requests per second per method
+        self.team_domain = team_domain
+        self.users: Dict[str, str] = {}  # user id -> username
+        self.messages: List[JsonDict] = []  # posted by the bot
+        self.reactions: List[JsonDict] = []  # added by the bot
+        self.calls: 'Counter[str]' = Counter()
+        self.errors: 'Counter[str]' = Counter()
+        self.rate_limited: 'Counter[str]' = Counter()
+        self.url = ''
+        self._random = random.Random(seed)
+        self._recent_calls: Dict[str, Deque[float]] = {}
+        self._websockets: Dict[web.WebSocketResponse, str] = {}
+        self._changed = asyncio.Condition()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def connected(self) -> bool:
+        return bool(self._websockets)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Start the server and return the base URL of its Web API.
+        """
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self._handle_api_call)
+        app.router.add_get('/rtm', self._handle_websocket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind((host, port))
+        (host, port) = sock.getsockname()[:2]
+        await web.SockSite(self._runner, sock).start()
+        self.url = f'http://{host}:{port}/api/'
+        return self.url
+
+    async def stop(self) -> None:
+        for websocket in list(self._websockets):
+            await websocket.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def send_event(
+            self,
+            event: Mapping[str, Any],
+            team_id: Optional[str] = None,
+    ) -> None:
+        """
+        Send an event to the connected RTM clients of given team or all.
+        """
+        for (websocket, team) in list(self._websockets.items()):
+            if team_id is None or team == team_id:
+                await websocket.send_str(json.dumps(event))
+
+    @classmethod
+    def get_team_id(cls, token: str) -> str:
+        """
+        Get the id of the team the given token belongs to.
+        """
+        digest = hashlib.sha1(token.encode('utf-8')).hexdigest()
+        return f'T{digest[:8].upper()}'
+
+    async def wait_for(
+            self,
+            predicate: Callable[['FakeSlackServer'], bool],
+            timeout: float,
+    ) -> None:
+        """
+        Wait until predicate returns true for this server.
+        """
+        async with self._changed:
+            await asyncio.wait_for(
+                self._changed.wait_for(lambda: predicate(self)), timeout)
+
+    async def _handle_websocket(
+            self,
+            request: web.Request,
+    ) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self._websockets[websocket] = request.query.get('team', '')
+        await self._notify()
+        await websocket.send_str(json.dumps({'type': 'hello'}))
+        try:
+            async for message in websocket:
+                if message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self._websockets.pop(websocket, None)
+            await self._notify()
+        return websocket
+
+    async def _handle_api_call(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._is_rate_limited(method):
+            self.rate_limited[method] += 1
+            return web.json_response(
+                {'ok': False, 'error': 'ratelimited'},
+                status=429, headers={'Retry-After': '1'})
+        if method in self.error_methods and (
+                self._random.random() < self.error_rate):
+            self.errors[method] += 1
+            return web.json_response(
+                {'ok': False, 'error': 'internal_error'}, status=500)
+        params = await self._get_params(request)
+        token = params.get('token') or (
+            request.headers.get('Authorization', '').split(' ')[-1])
+        params['team_id'] = self.get_team_id(token)
+        response = self._respond(method, params, request)
+        await self._notify()
+        return web.json_response(response)
+
+    def _is_rate_limited(self, method: str) -> bool:
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        recent = self._recent_calls.setdefault(method, deque())
+        while recent and recent[0] < now - 1.0:
+            recent.popleft()
+        if len(recent) >= self.rate_limit:
+            return True
+        recent.append(now)
+        return False
+
+    async def _get_params(self, request: web.Request) -> JsonDict:
+        params: JsonDict = dict(request.query)
+        if request.content_type == 'application/json':
+            params.update(await request.json())
+        elif request.can_read_body:
+            params.update(await request.post())
+        return params
+
+    def _respond(
+            self,
+            method: str,
+            params: JsonDict,
+            request: web.Request,
+    ) -> JsonDict:
+        team_id = params.pop('team_id')
+        if method == 'rtm.connect':
+            return {
+                'ok': True,
+                'url': str(request.url.with_path('/rtm').with_query(
+                    {'team': team_id})),
+                'self': {'id': 'UPEPUBOT', 'name': 'pepubot'},
+                'team': {'id': team_id, 'domain': self.team_domain},
+            }
+        elif method == 'auth.test':
+            return {'ok': True, 'team_id': team_id, 'user_id': 'UPEPUBOT',
+                    'url': f'https://{self.team_domain}.slack.com/'}
+        elif method == 'chat.postMessage':
+            message = dict(params, ts=f'{time.time():.6f}', team_id=team_id)
+            self.messages.append(message)
+            return {'ok': True, 'channel': params.get('channel'),
+                    'ts': message['ts']}
+        elif method == 'reactions.add':
+            self.reactions.append(dict(params, received_at=time.time()))
+            return {'ok': True}
+        elif method == 'users.info':
+            user_id = params.get('user', '')
+            if user_id not in self.users:
+                return {'ok': False, 'error': 'user_not_found'}
+            return {'ok': True, 'user': {
+                'id': user_id, 'name': self.users[user_id]}}
+        elif method == 'chat.getPermalink':
+            channel = params.get('channel', '')
+            ts = params.get('message_ts', '').replace('.', '')
+            return {'ok': True, 'channel': channel, 'permalink': (
+                f'https://{self.team_domain}.slack.com'
+                f'/archives/{channel}/p{ts}')}
+        return {'ok': False, 'error': 'unknown_method'}
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
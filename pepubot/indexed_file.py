@@ -0,0 +1,102 @@
+"""
+Indexed storage file format.
+
+The file consists of a header line, the version values each encoded as
+a compact JSON list of strings on its own line, an index line and a
+fixed width trailer::
+
+    PEPUBOT-INDEXED 1
+    ["line 1","line 2"]
+    ...
+    {"name": [[timestamp, offset, length], ...], ...}
+    00000000000000001234
+
+The index maps each item name to its versions (oldest first) with the
+offset and length of the encoded value within the file and the trailer
+contains the offset of the index.  This allows reading any single value
+without decoding the rest of the file.
+"""
+import json
+import mmap
+from typing import IO, Dict, Iterable, List, Sequence, Tuple, Union
+
+MAGIC = b'PEPUBOT-INDEXED 1\n'
+
+_TRAILER_LENGTH = 21  # 20 digits and a newline
+
+#: Location of an encoded value in the file: (offset, length)
+Location = Tuple[int, int]
+
+#: Index of the file: {name: [(timestamp, location), ...]}
+Index = Dict[str, List[Tuple[int, Location]]]
+
+#: Contents of the file, either read or memory-mapped
+Buffer = Union[bytes, mmap.mmap]
+
+
+def is_indexed_file(data: Buffer) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_index(data: Buffer) -> Index:
+    if not is_indexed_file(data) or len(data) < (
+            len(MAGIC) + _TRAILER_LENGTH):
+        raise ValueError('Not an indexed storage file')
+    index_offset = int(data[-_TRAILER_LENGTH:])
+    raw_index = json.loads(data[index_offset:-_TRAILER_LENGTH])
+    if not isinstance(raw_index, dict):
+        raise TypeError('Storage index should be a JSON dict')
+    index: Index = {}
+    for (name, versions) in raw_index.items():
+        if not isinstance(versions, list) or not all(
+                isinstance(x, list) and len(x) == 3
+                and all(isinstance(y, int) for y in x)
+                for x in versions):
+            raise TypeError(
+                'Each index entry should be a list of integer triples')
+        index[name] = [(ts, (offset, length))
+                       for (ts, offset, length) in versions]
+    return index
+
+
+def read_value(data: Buffer, location: Location) -> List[str]:
+    (offset, length) = location
+    value = json.loads(data[offset:offset + length])
+    if not isinstance(value, list) or not all(
+            isinstance(x, str) for x in value):
+        raise TypeError('Each value should be a list of strings')
+    return value
+
+
+def encode_value(value: Sequence[str]) -> bytes:
+    return json.dumps(
+        value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def write(
+        fp: IO[bytes],
+        items: Iterable[Tuple[str, Iterable[Tuple[int, bytes]]]],
+) -> Index:
+    """
+    Write given items to a file in the indexed format.
+
+    The items are given as pairs of item name and its versions, where
+    each version is a pair of timestamp and the encoded value.  Return
+    the index of the written file.
+    """
+    fp.write(MAGIC)
+    offset = len(MAGIC)
+    index: Index = {}
+    for (name, versions) in items:
+        entries = index[name] = []
+        for (timestamp, encoded_value) in versions:
+            fp.write(encoded_value)
+            fp.write(b'\n')
+            entries.append((timestamp, (offset, len(encoded_value))))
+            offset += len(encoded_value) + 1
+    fp.write(json.dumps({
+        name: [[ts, loc[0], loc[1]] for (ts, loc) in entries]
+        for (name, entries) in index.items()
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    fp.write(b'%020d\n' % offset)
+    return index
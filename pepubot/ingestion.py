@@ -0,0 +1,279 @@
+"""
+Event ingestion queue.
+
+Events from Slack are put to a bounded `EventQueue`, which hands them
+to the event handler from per-channel workers.  Events of a single
+channel are handled in the order they were received, while events of
+different channels may be handled concurrently, up to a limit.
+
+When the queue is full, new events are handled according to the
+overflow policy:
+
+* ``block``: Wait until there is room in the queue.
+
+* ``drop_ignorable``: Drop chatter, i.e. events which are known to be
+  ignorable, starting from the oldest queued ones.  If there is no
+  chatter to drop, wait like with ``block``.
+
+* ``spill``: Write the events to a spill file on disk and read them
+  back in order when there is room in the queue again.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from enum import Enum
+from typing import (Any, Awaitable, Callable, Deque, Dict, Mapping, NamedTuple,
+                    Optional, Set)
+
+from .settings import get_settings
+
+LOG = logging.getLogger(__name__)
+
+EventData = Mapping[str, Any]
+EventHandler = Callable[[EventData], Awaitable[None]]
+
+
+class OverflowPolicy(Enum):
+    block = 'block'
+    drop_ignorable = 'drop_ignorable'
+    spill = 'spill'
+
+
+class QueueStats(NamedTuple):
+    queued: int  # number of events queued in memory
+    spilled: int  # number of events in the spill file
+    dropped: int  # number of dropped events
+    handled: int  # number of handled events
+    lag: float  # age of the oldest unhandled event in seconds
+
+
+class _QueuedEvent(NamedTuple):
+    received_at: float  # seconds since 1970-01-01T00:00:00Z
+    data: EventData
+
+
+def create_event_queue(
+        handler: EventHandler,
+        is_ignorable: Callable[[EventData], bool],
+) -> 'EventQueue':
+    settings = get_settings()
+    return EventQueue(
+        handler,
+        max_size=int(settings.QUEUE_SIZE),
+        max_workers=int(settings.QUEUE_WORKERS),
+        overflow_policy=OverflowPolicy(settings.QUEUE_OVERFLOW_POLICY),
+        is_ignorable=is_ignorable,
+        spill_file=settings.QUEUE_SPILL_FILE,
+        lag_warning_threshold=float(settings.QUEUE_LAG_WARNING))
+
+
+class EventQueue:
+    def __init__(
+            self,
+            handler: EventHandler,
+            *,
+            max_size: int = 1000,
+            max_workers: int = 8,
+            overflow_policy: OverflowPolicy = OverflowPolicy.block,
+            is_ignorable: Callable[[EventData], bool] = lambda x: False,
+            spill_file: Optional[str] = None,
+            lag_warning_threshold: float = 10.0,
+    ) -> None:
+        if overflow_policy == OverflowPolicy.spill and not spill_file:
+            raise ValueError('Spill file is required for spill policy')
+        self.handler = handler
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.is_ignorable = is_ignorable
+        self.lag_warning_threshold = lag_warning_threshold
+        self._channels: Dict[str, Deque[_QueuedEvent]] = {}
+        self._workers: Set['asyncio.Task[None]'] = set()  # Strong refs
+        self._worker_slots = asyncio.Semaphore(max_workers)
+        self._changed = asyncio.Condition()
+        self._spill = _SpillFile(spill_file) if (
+            overflow_policy == OverflowPolicy.spill and spill_file) else None
+        self._size = 0
+        self._dropped = 0
+        self._handled = 0
+        self._closed = False
+        if self._spill and self._spill.count:
+            # Handle the events left by a previous process once running
+            asyncio.get_event_loop().call_soon(self._refill_from_spill)
+
+    def get_stats(self) -> QueueStats:
+        oldest = min((x[0].received_at for x in self._channels.values()
+                      if x), default=None)
+        return QueueStats(
+            queued=self._size,
+            spilled=self._spill.count if self._spill else 0,
+            dropped=self._dropped,
+            handled=self._handled,
+            lag=(time.time() - oldest) if oldest is not None else 0.0)
+
+    async def put(self, data: EventData) -> None:
+        if self._closed:
+            raise RuntimeError('Event queue is closed')
+        event = _QueuedEvent(time.time(), data)
+        if self._spill and (self._spill.count or self._size >= self.max_size):
+            self._spill.append(event)  # Keep the order by spilling
+            self._refill_from_spill()
+            return
+        if self._size >= self.max_size and (
+                self.overflow_policy == OverflowPolicy.drop_ignorable):
+            if self.is_ignorable(data):
+                self._dropped += 1
+                return
+            self._drop_oldest_ignorable()
+        async with self._changed:
+            while self._size >= self.max_size:
+                await self._changed.wait()
+            self._enqueue(event)
+
+    async def drain(self) -> None:
+        """
+        Stop accepting new events and wait until queued events are handled.
+        """
+        self._closed = True
+        self._refill_from_spill()
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: not self._channels and not (
+                    self._spill and self._spill.count))
+
+    def _enqueue(self, event: _QueuedEvent) -> None:
+        channel = event.data.get('channel') or ''
+        events = self._channels.get(channel)
+        self._size += 1
+        if events is not None:
+            events.append(event)
+            return
+        self._channels[channel] = deque([event])
+        worker = asyncio.ensure_future(self._work(channel))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    def _drop_oldest_ignorable(self) -> None:
+        candidates = [
+            (events[n].received_at, events, n)
+            for events in self._channels.values()
+            for n in range(1, len(events))  # The first one is in handling
+            if self.is_ignorable(events[n].data)]
+        if candidates:
+            (_received_at, events, n) = min(candidates, key=lambda x: x[0])
+            del events[n]
+            self._size -= 1
+            self._dropped += 1
+
+    async def _work(self, channel: str) -> None:
+        events = self._channels[channel]
+        try:
+            while events:
+                await self._handle_first(events)
+                if not events:
+                    del self._channels[channel]
+                self._refill_from_spill()
+                await self._notify()
+        finally:
+            if self._channels.get(channel) is events:  # Worker was stopped
+                del self._channels[channel]
+                LOG.error('Dropping %d unhandled events of channel %s',
+                          len(events), channel)
+                self._size -= len(events)
+                self._dropped += len(events)
+                asyncio.ensure_future(self._notify())
+
+    async def _handle_first(self, events: Deque[_QueuedEvent]) -> None:
+        event = events[0]
+        lag = time.time() - event.received_at
+        if lag > self.lag_warning_threshold:
+            LOG.warning('Event queue lag is %.1f s: %s', lag, (
+                self.get_stats()))
+        async with self._worker_slots:
+            try:
+                await self.handler(event.data)
+            except Exception:
+                LOG.exception('Error while handling event: %r', event.data)
+        events.popleft()
+        self._size -= 1
+        self._handled += 1
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _refill_from_spill(self) -> None:
+        while self._spill and self._spill.count and (
+                self._size < self.max_size):
+            event = self._spill.pop()
+            if event:
+                self._enqueue(event)
+
+
+class _SpillFile:
+    """
+    File of spilled events in the JSON lines format.
+
+    Events left in the file by a previous process are read back first.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.count = 0
+        self._read_offset = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as fp:
+                self.count = sum(1 for line in fp if line.strip())
+
+    def append(self, event: _QueuedEvent) -> None:
+        line = json.dumps({'received_at': event.received_at,
+                           'data': event.data}, ensure_ascii=False)
+        with open(self.filename, 'at', encoding='utf-8') as fp:
+            fp.write(line + '\n')
+        self.count += 1
+
+    def pop(self) -> Optional[_QueuedEvent]:
+        """
+        Pop the oldest event from the file.
+
+        Lines which cannot be parsed, like one left partially written by
+        a crash, are skipped.  Return None if no event could be read.
+        """
+        line = self._read_line()
+        self.count -= 1
+        if not self.count or line is None:
+            self._clear()
+        if line is None:
+            return None
+        try:
+            item = json.loads(line)
+            return _QueuedEvent(float(item['received_at']), item['data'])
+        except (ValueError, KeyError, TypeError):
+            LOG.warning('Skipping a bad line in spill file: %r', line[:100])
+            return None
+
+    def _read_line(self) -> Optional[bytes]:
+        try:
+            with open(self.filename, 'rb') as fp:
+                fp.seek(self._read_offset)
+                line = fp.readline()
+                while line and not line.strip():
+                    line = fp.readline()
+                self._read_offset = fp.tell()
+        except OSError as error:
+            LOG.error('Cannot read spill file: %s', error)
+            return None
+        if not line:
+            LOG.error('Spill file %s ended before %d events were read',
+                      self.filename, self.count)
+            return None
+        return line
+
+    def _clear(self) -> None:
+        self.count = 0
+        self._read_offset = 0
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
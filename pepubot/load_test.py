@@ -0,0 +1,293 @@
+"""
+End-to-end load test.
+
+Runs PePuBot in a subprocess against a `FakeSlackServer` and drives a
+full PePu round through it: The round is started, a burst of simulated
+users post media to the PePu channel, the round is ended and a winner
+is picked.  Then the bot is stopped and the stored lottery box is
+checked against the correctness invariants.
+"""
+import asyncio
+import os
+import random
+import re
+import signal
+import sys
+import time
+from collections import Counter
+from typing import (Dict, List, Mapping, NamedTuple, Optional, Sequence, Set,
+                    TextIO)
+
+from .fake_slack import FakeSlackServer
+from .lottery_box import Ticket, iter_tickets
+from .storage import Version, iter_file_versions
+
+CHANNEL = 'CPEPU'
+STARTER = 'U00000'
+
+
+class LoadTestReport(NamedTuple):
+    users: int
+    messages: int  # number of media messages posted
+    duration: float  # seconds from the first media post to the round end
+    throughput: float  # media messages handled per second
+    latency_p50: float  # seconds from a media post to its reaction
+    latency_p99: float
+    tickets: int  # number of tickets added in the round
+    winner: Optional[str]
+    api_calls: Mapping[str, int]
+    api_errors: Mapping[str, int]
+    rate_limited: Mapping[str, int]
+    violations: Sequence[str]  # broken correctness invariants
+
+
+async def run_load_test(
+        work_dir: str,
+        *,
+        users: int = 1000,
+        posts_per_user: int = 2,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: int = 0,
+        seed: Optional[int] = None,
+        timeout: float = 300.0,
+) -> LoadTestReport:
+    server = FakeSlackServer(
+        latency=latency, error_rate=error_rate, rate_limit=rate_limit,
+        seed=seed)
+    server.users = {f'U{n:05}': f'user{n}' for n in range(users + 1)}
+    await server.start()
+    storage_file = os.path.join(work_dir, 'pepubot-data.json')
+    bot = await _start_bot(server.url, storage_file, work_dir)
+    try:
+        await server.wait_for(lambda x: x.connected, timeout)
+        posted = await _run_round(
+            server, users, posts_per_user, random.Random(seed), timeout)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        await bot.wait()
+        await server.stop()
+    return _make_report(server, users, posted, storage_file)
+
+
+class _PostedMessages(NamedTuple):
+    authors: Dict[str, str]  # ts -> user id
+    posted_at: Dict[str, float]  # ts -> time
+    started_at: float
+    ended_at: float
+
+
+async def _start_bot(
+        api_url: str,
+        storage_file: str,
+        work_dir: str,
+) -> 'asyncio.subprocess.Process':
+    env = dict(
+        os.environ,
+        SLACK_API_TOKEN='xoxb-load-test',
+        SLACK_API_URL=api_url,
+        STORAGE_FILE=storage_file,
+        QUEUE_SPILL_FILE=os.path.join(work_dir, 'pepubot-queue.jsonl'),
+        DRUMROLL_DURATION='0')
+    with open(os.path.join(work_dir, 'pepubot.log'), 'wb') as log:
+        return await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'pepubot',
+            '--config-file', os.path.join(work_dir, 'pepubot.conf'),
+            env=env, stdout=log, stderr=log)
+
+
+async def _run_round(
+        server: FakeSlackServer,
+        users: int,
+        posts_per_user: int,
+        rng: random.Random,
+        timeout: float,
+) -> _PostedMessages:
+    await _say(server, STARTER, 'pepu open')
+    await _wait_for_message(server, 'PePu is on!', timeout)
+
+    posts = [f'U{n:05}' for n in range(1, users + 1)] * posts_per_user
+    rng.shuffle(posts)
+    authors: Dict[str, str] = {}
+    posted_at: Dict[str, float] = {}
+    started_at = time.time()
+    for user_id in posts:
+        ts = await _say(server, user_id, '', files=[{
+            'mimetype': 'image/png',
+            'permalink': f'https://files.example.com/{len(authors)}.png',
+        }])
+        authors[ts] = user_id
+        posted_at[ts] = time.time()
+
+    await _say(server, STARTER, 'pepu over')
+    await _wait_for_message(server, 'Ending PePu round.', timeout)
+    ended_at = time.time()
+    await _wait_for_message(server, 'Choose a number', timeout)
+    await _say(server, STARTER, '1')
+    await _wait_for_message(server, 'The winning ticket was', timeout)
+    return _PostedMessages(authors, posted_at, started_at, ended_at)
+
+
+_ts_counter = 0
+
+
+async def _say(
+        server: FakeSlackServer,
+        user_id: str,
+        text: str,
+        **fields: object,
+) -> str:
+    global _ts_counter
+    _ts_counter += 1
+    ts = f'{int(time.time())}.{_ts_counter:06}'
+    await server.send_event(dict(
+        type='message', channel=CHANNEL, user=user_id, ts=ts, text=text,
+        **fields))
+    return ts
+
+
+async def _wait_for_message(
+        server: FakeSlackServer,
+        text: str,
+        timeout: float,
+) -> None:
+    await server.wait_for(lambda x: any(
+        y.get('text', '').startswith(text) for y in x.messages), timeout)
+
+
+def _make_report(
+        server: FakeSlackServer,
+        users: int,
+        posted: _PostedMessages,
+        storage_file: str,
+) -> LoadTestReport:
+    latencies = sorted(
+        float(x['received_at']) - posted.posted_at[x['timestamp']]
+        for x in server.reactions if x.get('timestamp') in posted.posted_at)
+    duration = posted.ended_at - posted.started_at
+    box_versions = [
+        version for (name, version) in iter_file_versions(storage_file)
+        if name == 'lottery_box']
+    round_tickets = (
+        list(iter_tickets(box_versions[-2].value))
+        if len(box_versions) >= 2 else [])
+    winner = _get_winner(server)
+    return LoadTestReport(
+        users=users,
+        messages=len(posted.authors),
+        duration=duration,
+        throughput=len(posted.authors) / duration if duration else 0.0,
+        latency_p50=_percentile(latencies, 0.50),
+        latency_p99=_percentile(latencies, 0.99),
+        tickets=len(round_tickets),
+        winner=winner,
+        api_calls=dict(server.calls),
+        api_errors=dict(server.errors),
+        rate_limited=dict(server.rate_limited),
+        violations=(
+            _check_tickets(server, posted, round_tickets)
+            + _check_winner(winner, round_tickets, box_versions[-1:])))
+
+
+def _get_winner(server: FakeSlackServer) -> Optional[str]:
+    for message in server.messages:
+        match = re.match(r'The winner is <@(\w+)>', message.get('text', ''))
+        if match:
+            return match.group(1)
+    return None
+
+
+def _check_tickets(
+        server: FakeSlackServer,
+        posted: _PostedMessages,
+        tickets: Sequence[Ticket],
+) -> List[str]:
+    violations: List[str] = []
+    tickets_per_user = Counter(x.owner_user_id for x in tickets)
+    violations.extend(
+        f'User {user_id} has {count} tickets from the round'
+        for (user_id, count) in sorted(tickets_per_user.items())
+        if count > 1)
+    ticket_numbers = Counter(x.number for x in tickets)
+    violations.extend(
+        f'Ticket number {number} is duplicated'
+        for (number, count) in sorted(ticket_numbers.items()) if count > 1)
+    violations.extend(
+        f'Ticket {x.id} does not match a message of {x.owner_user_id}'
+        for x in tickets
+        if posted.authors.get(x.source_message_ts) != x.owner_user_id)
+    reactions_per_message = Counter(
+        x.get('timestamp') for x in server.reactions)
+    violations.extend(
+        f'Message {ts} got {count} reactions'
+        for (ts, count) in sorted(reactions_per_message.items())
+        if count > 1)
+    violations.extend(
+        f'User {user_id} did not get a ticket'
+        for user_id in sorted(_get_expected_owners(server, posted)
+                              - set(tickets_per_user)))
+    return violations
+
+
+def _get_expected_owners(
+        server: FakeSlackServer,
+        posted: _PostedMessages,
+) -> Set[str]:
+    """
+    Get users who must have a ticket from the round.
+
+    Without failures that is every user who posted.  Otherwise it's the
+    users whose message got the accepted reaction.
+    """
+    if not server.errors and not server.rate_limited:
+        return set(posted.authors.values())
+    return {
+        posted.authors[x['timestamp']] for x in server.reactions
+        if x.get('name') == 'heavy_check_mark'
+        and x.get('timestamp') in posted.authors}
+
+
+def _check_winner(
+        winner: Optional[str],
+        tickets: Sequence[Ticket],
+        last_box_versions: Sequence[Version],
+) -> List[str]:
+    if not tickets:
+        return []
+    if not winner:
+        return ['No winner was announced']
+    if winner not in {x.owner_user_id for x in tickets}:
+        return [f'Winner {winner} had no tickets']
+    remaining = list(iter_tickets(last_box_versions[0].value))
+    if any(x.owner_user_id == winner for x in remaining) or (
+            len(remaining) != len(
+                [x for x in tickets if x.owner_user_id != winner])):
+        return ['Tickets of the winner were not removed correctly']
+    return []
+
+
+def _percentile(values: Sequence[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[round(fraction * (len(values) - 1))]
+
+
+def print_report(report: LoadTestReport, output: TextIO) -> None:
+    print(f'Users:          {report.users}', file=output)
+    print(f'Media messages: {report.messages}', file=output)
+    print(f'Duration:       {report.duration:.2f} s', file=output)
+    print(f'Throughput:     {report.throughput:.1f} messages/s', file=output)
+    print(f'Latency p50:    {report.latency_p50 * 1000:.1f} ms', file=output)
+    print(f'Latency p99:    {report.latency_p99 * 1000:.1f} ms', file=output)
+    print(f'Tickets:        {report.tickets}', file=output)
+    print(f'Winner:         {report.winner}', file=output)
+    for (title, counts) in [
+            ('API calls', report.api_calls),
+            ('API errors', report.api_errors),
+            ('Rate limited', report.rate_limited)]:
+        print(f'{title + ":":15} ' + (', '.join(
+            f'{method}={count}' for (method, count) in sorted(
+                counts.items())) or '-'), file=output)
+    print(f'Violations:     {len(report.violations)}', file=output)
+    for violation in report.violations:
+        print(f'  {violation}', file=output)
@@ -1,9 +1,7 @@
 import random
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Iterable, List, Optional
-
-from dateutil.parser import parse as parse_datetime
+from typing import Iterable, Iterator, List, Optional, Sequence
 
 from .hashing import sha256
 from .messages import MessageInfo
@@ -53,7 +51,7 @@ class Ticket:
             raise ValueError(f'Not a Ticket string: {string}')
         return cls(
             number=int(num[1:]),
-            created_at=parse_datetime(created),
+            created_at=_parse_datetime(created),
             source_message_channel=msgch,
             source_message_ts=msgts,
             owner_user_id=uid,
@@ -126,15 +124,34 @@ class LotteryBox:
     @classmethod
     def from_string(cls, string: str, storage: Storage) -> 'LotteryBox':
         lines = string.splitlines()
-        tickets = [
-            Ticket.from_string(x.strip().split(' ', 1)[-1])
-            for x in lines[:-1]] if lines[0] and len(lines) >= 2 else []
-        last_line = lines[-1]
-        if not last_line.startswith('next_ticket_number='):
-            raise ValueError('next_ticket_number is missing')
-        next_ticket_num = int(last_line.split('=', 1)[-1].rstrip())
+        tickets = list(iter_tickets(lines))
+        next_ticket_num = get_next_ticket_number(lines)
         return cls(
             tickets=tickets,
             next_ticket_number=next_ticket_num,
             storage=storage,
         )
+
+
+def iter_tickets(lines: Sequence[str]) -> Iterator[Ticket]:
+    """
+    Iterate the tickets of a lottery box string splitted into lines.
+    """
+    if lines[0] and len(lines) >= 2:
+        for line in lines[:-1]:
+            yield Ticket.from_string(line.strip().split(' ', 1)[-1])
+
+
+def get_next_ticket_number(lines: Sequence[str]) -> int:
+    last_line = lines[-1]
+    if not last_line.startswith('next_ticket_number='):
+        raise ValueError('next_ticket_number is missing')
+    return int(last_line.split('=', 1)[-1].rstrip())
+
+
+def _parse_datetime(string: str) -> datetime:
+    try:
+        return datetime.fromisoformat(string)
+    except ValueError:  # Not written by us, use the slower generic parser
+        from dateutil.parser import parse
+        return parse(string)
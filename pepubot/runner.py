@@ -1,42 +1,67 @@
 import asyncio
 import re
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Any, List, Mapping, Optional
-
-import slack
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Dict, List, Mapping,
+                    Optional, Set)
 
 from .lottery_box import get_lottery_box
 from .messages import Message, MessageInfo
+from .settings import get_settings
 from .storage import get_default_storage
 from .userinfo import get_username
 
+if TYPE_CHECKING:
+    import slack
+
+    from .lottery_box import Ticket
+
 ENTRY_ACCEPTED_EMOJI = 'heavy_check_mark'
 ENTRY_SKIPPED_EMOJI = 'white_check_mark'
 
+_state_locks: Dict[str, asyncio.Lock] = {}  # storage filename -> lock
+_announcing: Set[str] = set()  # storage filenames
+
 
 class PePuState(Enum):
     not_started = 'not_started'
     running = 'running'
     picking_winner = 'picking_winner'
+    announcing_winner = 'announcing_winner'
 
 
 class PePuRunner:
-    def __init__(self, slack_client: slack.WebClient) -> None:
+    def __init__(self, slack_client: 'slack.WebClient') -> None:
         self.slack = slack_client
         self.state: PePuState = PePuState.not_started
         self.start_message: Optional[MessageInfo] = None
         self.round_participants: List[str] = []
-        self._lock = asyncio.Lock()
 
     async def feed_message(self, event_data: Mapping[str, Any]) -> None:
         message = Message.from_message_event(event_data)
         if not message:
             return
 
-        await self._load()
+        async with _get_state_lock():
+            await self._load()
 
         await self._handle_message(message)
 
+    @asynccontextmanager
+    async def _changing_state(self) -> AsyncIterator[None]:
+        """
+        Hold the state lock with the latest state loaded.
+
+        The state is stored as several items and messages of different
+        channels are handled concurrently, so the state must be checked
+        and changed while holding the lock shared by all the runners.
+        Slack should not be called while holding it, since that would
+        block the other channels.
+        """
+        async with _get_state_lock():
+            await self._load()
+            yield
+
     async def _handle_message(self, message: Message) -> None:
         if self.is_dump_lottery_box_command(message):
             await self.dump_lottery_box(message)
@@ -91,26 +116,42 @@ class PePuRunner:
         if message.author != self.start_message.author:
             # Only PePu starter can end it
             return False
-        return re.match(
-            r'^('
-            r'(pepu ((is|has) )?(now )?(over\b|end|off)'
-            r')|('
-            r'(end|stop|kill) pepu)'
-            r')',
-            message.text.strip(),
-            re.IGNORECASE) is not None
+        return _is_pepu_end_command(message.text)
 
-    async def start_pepu(self, message: Message) -> None:
-        async with self._lock:
-            self.start_message = message.info
-            self.state = PePuState.running
-            await self._save()
-        await self.say('PePu is on!')
+    def is_ignorable_event(self, event_data: Mapping[str, Any]) -> bool:
+        """
+        Check if given event is chatter which can be dropped under load.
 
-    async def say(self, text: str) -> None:
-        assert self.start_message
-        await self.slack.chat_postMessage(
-            channel=self.start_message.channel, text=text)
+        Chatter is anything else than a message with media or a message
+        which could be a command, regardless of the current state.
+        """
+        message = Message.from_message_event(event_data)
+        if not message:
+            return True
+        return not (
+            message.media_urls
+            or self.is_pepu_start_message(message)
+            or _is_pepu_end_command(message.text)
+            or self.is_dump_lottery_box_command(message)
+            or message.text.strip().strip('.').isdigit())
+
+    async def start_pepu(self, message: Message) -> None:
+        async with self._changing_state():
+            started = (self.state == PePuState.not_started)
+            if started:
+                self.start_message = message.info
+                self.state = PePuState.running
+                await self._save()
+        if started:
+            await self.say('PePu is on!')
+        else:  # Started meanwhile from another message
+            await self._handle_message_during_running(message)
+
+    async def say(self, text: str, channel: Optional[str] = None) -> None:
+        if not channel:
+            assert self.start_message
+            channel = self.start_message.channel
+        await self.slack.chat_postMessage(channel=channel, text=text)
 
     async def handle_non_pepu_channel_message(self, message: Message) -> None:
         if self.is_pepu_start_message(message) or (
@@ -120,6 +161,8 @@ class PePuRunner:
                 text='Sorry! Currently running PePu on another channel.')
 
     async def handle_message_with_media(self, message: Message) -> None:
+        from slack.errors import SlackApiError
+
         if message.author in self.round_participants:
             added_participant = False
         else:
@@ -131,18 +174,24 @@ class PePuRunner:
                       ENTRY_SKIPPED_EMOJI),
                 channel=message.channel,
                 timestamp=message.ts)
-        except slack.errors.SlackApiError as error:
+        except SlackApiError as error:
             # Ignore already_reacted errors and re-raise everything else
             if not isinstance(error.response, dict) or (
                     error.response.get('error') != 'already_reacted'):
                 raise
 
     async def add_participant(self, message: Message) -> bool:
-        async with self._lock:
-            if message.author in self.round_participants:
+        if message.author in self.round_participants:
+            return False
+
+        username = await get_username(self.slack, message.author)
+        async with self._changing_state():
+            if self.state != PePuState.running or (
+                    not self.start_message
+                    or message.channel != self.start_message.channel
+                    or message.author in self.round_participants):
                 return False
 
-            username = await get_username(self.slack, message.author)
             box = await get_lottery_box()
             if not self.round_participants:
                 # Add a new version of the lottery box for the new round
@@ -151,25 +200,23 @@ class PePuRunner:
 
             self.round_participants.append(message.author)
             await self._save()
-            return True
+        return True
 
     async def handle_message_with_bare_urls(self, message: Message) -> None:
         pass  # TODO: Should we notify that these are not counted?
 
     async def end_pepu(self, message: Message) -> None:
-        # Make sure new participants are not being added while we are in
-        # middle of ending the PePu round
-        async with self._lock:
+        async with self._changing_state():
             if self.state != PePuState.running:
-                return  # Already (being) ended
+                return  # Already ended
+            assert self.start_message
+            channel = self.start_message.channel
 
             box = await get_lottery_box()
 
             if not box.tickets:
-                await self.say('No tickets, no winners.')
-                self.state = PePuState.not_started
-                self.start_message = None
-                self.round_participants = []
+                texts = ['No tickets, no winners.']
+                self._reset()
             else:
                 # TODO: Clean-up deactivated Slack users
                 await box.shuffle()
@@ -177,57 +224,81 @@ class PePuRunner:
                 max_number = len(box.tickets)
                 participants_in_box = len(
                     set(x.owner_user_id for x in box.tickets))
-                await self.say(f'Ending PePu round.')
-                await self.say(
+                texts = [
+                    f'Ending PePu round.',
                     f'Added {len(self.round_participants)} new tickets '
                     f'to the lottery box. '
                     f'There are currently {len(box.tickets)} tickets from '
                     f'{participants_in_box} participants. '
-                    f'Box checksum is {box_checksum}')
-                await self.say(
+                    f'Box checksum is {box_checksum}',
                     f'Choose a number from *1 to {max_number}* '
-                    f'to pick the winning ticket.')
+                    f'to pick the winning ticket.',
+                ]
                 self.state = PePuState.picking_winner
 
             await self._save()
 
+        for text in texts:
+            await self.say(text, channel)
+
     async def pick_winner(self, message: Message, number: int) -> None:
-        async with self._lock:
+        async with self._changing_state():
             if self.state != PePuState.picking_winner:
                 return
 
             box = await get_lottery_box()
 
             if number < 1 or number > len(box.tickets):
-                await self.say("That isn't in the specified range. Try again.")
-                return
+                ticket = None
+            else:
+                # Pick the winner now and announce it without the lock
+                ticket = box.tickets[number - 1]
+                winner = ticket.owner_user_id
+                winner_ticket_count = len(
+                    [x for x in box.tickets if x.owner_user_id == winner])
+                await box.save(add_new_version=True)
+                await box.remove_tickets_of_person(winner)
+                self.state = PePuState.announcing_winner
+                await self._save()
+                _announcing.add(get_default_storage().filename)
 
-            ticket = box.tickets[number - 1]
-            winner = ticket.owner_user_id
-            winner_ticket_count = len(
-                [x for x in box.tickets if x.owner_user_id == winner])
-
-            await self.say(
-                f'Winning ticket is {ticket.id} from {ticket.created_at}. '
-                f'The winner had {winner_ticket_count} tickets in the box...')
-            await asyncio.sleep(3)
-            await self.say(':drumroll: :drumroll: :drumroll:')
-            await asyncio.sleep(7)
-            await self.say(f'The winner is <@{winner}>! :tada:')
-            link_to_ticket_origin = await self.get_permalink(
-                channel=ticket.source_message_channel,
-                ts=ticket.source_message_ts)
-            await self.say(
-                f'The winning ticket was created from this message: '
-                f'<{link_to_ticket_origin}>')
-
-            await box.save(add_new_version=True)
-            await box.remove_tickets_of_person(winner)
+        if not ticket:
+            await self.say("That isn't in the specified range. Try again.")
+            return
 
-            self.state = PePuState.not_started
-            self.start_message = None
-            self.round_participants = []
-            await self._save()
+        try:
+            await self._announce_winner(ticket, winner_ticket_count)
+        finally:
+            async with self._changing_state():
+                _announcing.discard(get_default_storage().filename)
+                if self.state == PePuState.announcing_winner:
+                    self._reset()
+                    await self._save()
+
+    async def _announce_winner(
+            self,
+            ticket: 'Ticket',
+            winner_ticket_count: int,
+    ) -> None:
+        await self.say(
+            f'Winning ticket is {ticket.id} from {ticket.created_at}. '
+            f'The winner had {winner_ticket_count} tickets in the box...')
+        drumroll_duration = float(get_settings().DRUMROLL_DURATION)
+        await asyncio.sleep(0.3 * drumroll_duration)
+        await self.say(':drumroll: :drumroll: :drumroll:')
+        await asyncio.sleep(0.7 * drumroll_duration)
+        await self.say(f'The winner is <@{ticket.owner_user_id}>! :tada:')
+        link_to_ticket_origin = await self.get_permalink(
+            channel=ticket.source_message_channel,
+            ts=ticket.source_message_ts)
+        await self.say(
+            f'The winning ticket was created from this message: '
+            f'<{link_to_ticket_origin}>')
+
+    def _reset(self) -> None:
+        self.state = PePuState.not_started
+        self.start_message = None
+        self.round_participants = []
 
     async def get_permalink(self, *, channel: str, ts: str) -> str:
         response = await self.slack.chat_getPermalink(
@@ -242,38 +313,41 @@ class PePuRunner:
             message.text, re.IGNORECASE) is not None
 
     async def dump_lottery_box(self, message: Message) -> None:
-        async with self._lock:
-            if self.state == PePuState.picking_winner:
-                text = 'Cannot dump the lottery box while picking winner'
+        if self.state == PePuState.picking_winner:
+            text = 'Cannot dump the lottery box while picking winner'
+        else:
+            to_dump = (
+                'current' if (
+                    'current' in message.text or 'now' in message.text or (
+                        self.state == PePuState.running
+                        and 'prev' not in message.text)) else 'previous')
+            from_back = {'current': 1, 'previous': 2}[to_dump]
+            when = 'in the last lottery' if from_back == 2 else 'right now'
+            storage = get_default_storage()
+            box_versions = await storage.get_all_versions('lottery_box')
+            version = box_versions[-from_back]
+            if len(box_versions) < from_back:
+                text = 'There is no lottery box yet'
             else:
-                to_dump = (
-                    'current' if (
-                        'current' in message.text or 'now' in message.text or (
-                            self.state == PePuState.running
-                            and 'prev' not in message.text)) else 'previous')
-                from_back = {'current': 1, 'previous': 2}[to_dump]
-                when = 'in the last lottery' if from_back == 2 else 'right now'
-                storage = get_default_storage()
-                box_versions = await storage.get_all_versions('lottery_box')
-                version = box_versions[-from_back]
-                if len(box_versions) < from_back:
-                    text = 'There is no lottery box yet'
-                else:
-                    text = (
-                        f'The lottery box contents {when}:\n'
-                        '```' + '\n'.join(version.value) + '```')
-            await self.slack.chat_postMessage(
-                channel=message.channel, text=text)
+                text = (
+                    f'The lottery box contents {when}:\n'
+                    '```' + '\n'.join(version.value) + '```')
+        await self.slack.chat_postMessage(
+            channel=message.channel, text=text)
 
     async def _load(self) -> None:
         storage = get_default_storage()
 
-        async with self._lock:
-            state = await storage.get_item('runner_state')
-            start_message = await storage.get_item('runner_start_message')
-            participants = await storage.get_item('runner_round_participants')
+        state = await storage.get_item('runner_state')
+        start_message = await storage.get_item('runner_start_message')
+        participants = await storage.get_item('runner_round_participants')
 
         self.state = PePuState(state or PePuState.not_started.value)
+        if self.state == PePuState.announcing_winner and (
+                storage.filename not in _announcing):
+            # The announcement was interrupted, e.g. by a restart, but
+            # the winner has already been removed from the box
+            self.state = PePuState.not_started
 
         self.start_message = (
             None if not start_message else
@@ -288,3 +362,22 @@ class PePuRunner:
             ' '.join(self.start_message) if self.start_message else ''))
         await storage.store_item('runner_round_participants', (
             '\n'.join(self.round_participants)))
+
+
+def _get_state_lock() -> asyncio.Lock:
+    filename = get_default_storage().filename  # Per workspace
+    lock = _state_locks.get(filename)
+    if lock is None:
+        lock = _state_locks[filename] = asyncio.Lock()
+    return lock
+
+
+def _is_pepu_end_command(text: str) -> bool:
+    return re.match(
+        r'^('
+        r'(pepu ((is|has) )?(now )?(over\b|end|off)'
+        r')|('
+        r'(end|stop|kill) pepu)'
+        r')',
+        text.strip(),
+        re.IGNORECASE) is not None
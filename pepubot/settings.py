@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import copy
 import os
-import shlex
-from os.path import expanduser
-from typing import Dict, Mapping, Optional
+from contextvars import ContextVar
+from os.path import expanduser, splitext
+from typing import Dict, List, Mapping, Optional
 
 _DEFAULT_SETTINGS_FILE_PATH = 'pepubot.conf'
 
 _settings_instance: Optional[Settings] = None
 
+_workspace_settings: ContextVar[Optional[Settings]] = ContextVar(
+    'pepubot_workspace_settings', default=None)
+
 
 def initialize_settings(
         settings_file: str = _DEFAULT_SETTINGS_FILE_PATH,
@@ -23,15 +27,37 @@ def initialize_settings(
 
 def get_settings() -> Settings:
     global _settings_instance
+    workspace_settings = _workspace_settings.get()
+    if workspace_settings:
+        return workspace_settings
     if not _settings_instance:
         return initialize_settings()
     return _settings_instance
 
 
+def use_workspace_settings(settings: Settings) -> None:
+    """
+    Use given settings in the current context instead of the global ones.
+
+    Tasks started from the current context will use them too.
+    """
+    _workspace_settings.set(settings)
+
+
 class Settings:
-    SLACK_API_TOKEN: str
+    SLACK_API_TOKEN: str = ''
+    SLACK_API_TOKENS: str = ''  # comma separated, one per workspace
+    SLACK_API_URL: str = 'https://www.slack.com/api/'
     STORAGE_FILE: str = expanduser('~/pepubot-data.json')
+    STORAGE_FORMAT: str = 'json'
+    STORAGE_MEMORY_LIMIT: str = str(4 * 1024 * 1024)
     TIMEZONE: str = 'UTC'
+    DRUMROLL_DURATION: str = '10'
+    QUEUE_SIZE: str = '1000'
+    QUEUE_WORKERS: str = '8'
+    QUEUE_OVERFLOW_POLICY: str = 'block'
+    QUEUE_SPILL_FILE: str = expanduser('~/pepubot-queue.jsonl')
+    QUEUE_LAG_WARNING: str = '10'
 
     def __init__(
             self,
@@ -51,6 +77,28 @@ class Settings:
             assert isinstance(value, str)
             setattr(self, name, value)
 
+    def get_api_tokens(self) -> List[str]:
+        tokens = [x.strip() for x in self.SLACK_API_TOKENS.split(',')]
+        result = [x for x in tokens if x] or (
+            [self.SLACK_API_TOKEN] if self.SLACK_API_TOKEN else [])
+        if not result:
+            raise RuntimeError('No value provided for SLACK_API_TOKEN')
+        return result
+
+    def for_workspace(self, token: str, team_id: str) -> Settings:
+        """
+        Get settings for a workspace with given token and team id.
+
+        The workspace gets files of its own by adding the team id to
+        the names of the configured files.
+        """
+        result = copy.copy(self)
+        result.SLACK_API_TOKEN = token
+        result.SLACK_API_TOKENS = ''
+        result.STORAGE_FILE = _add_suffix(self.STORAGE_FILE, team_id)
+        result.QUEUE_SPILL_FILE = _add_suffix(self.QUEUE_SPILL_FILE, team_id)
+        return result
+
     def _get_settings_file_variables(self) -> Dict[str, str]:
         if self._settings_file_variables is not None:
             return self._settings_file_variables
@@ -66,6 +114,18 @@ class Settings:
                 if not sline or sline.startswith('#'):
                     continue
                 (name, value) = sline.split('=', 1)
-                result[name] = shlex.split(value)[0]
+                result[name] = _unquote(value)
         self._settings_file_variables = result
         return result
+
+
+def _unquote(value: str) -> str:
+    if not any(x in value for x in ' \t\\#"\''):
+        return value  # Plain value, no need for the shell lexer
+    import shlex
+    return shlex.split(value)[0]
+
+
+def _add_suffix(path: str, suffix: str) -> str:
+    (root, ext) = splitext(path)
+    return f'{root}-{suffix}{ext}'
@@ -1,17 +1,28 @@
+from typing import TYPE_CHECKING, Optional
+
 import slack
 
 from .settings import get_settings
 
+if TYPE_CHECKING:
+    import aiohttp
+
 
-def get_web_client() -> slack.WebClient:
+def get_web_client(
+        session: Optional['aiohttp.ClientSession'] = None,
+        token: Optional[str] = None,
+) -> slack.WebClient:
     return slack.WebClient(
-        token=get_settings().SLACK_API_TOKEN,
+        token=token or get_settings().SLACK_API_TOKEN,
+        base_url=get_settings().SLACK_API_URL,
         run_async=True,
+        session=session,
     )
 
 
 def get_rtm_client() -> slack.RTMClient:
     return slack.RTMClient(
         token=get_settings().SLACK_API_TOKEN,
+        base_url=get_settings().SLACK_API_URL,
         run_async=True,
     )
@@ -0,0 +1,242 @@
+"""
+Compressed binary snapshot storage file format.
+
+The file consists of a header line, a fixed size header and a
+compressed payload::
+
+    PEPUBOT-SNAPSHOT 1
+    <codec: 4 bytes> <CRC-32 of the uncompressed payload: uint32>
+    <payload compressed with the codec>
+
+The codec is "zstd" if the zstandard package is installed when the file
+is written and "gzip" otherwise.  The uncompressed payload is a
+length-prefixed binary encoding of the items (all integers little
+endian)::
+
+    <number of lines: uint32> <length of lines: uint32>
+    <distinct lines joined with newlines: UTF-8>
+    <number of items: uint32>
+    for each item:
+        <name length: uint32> <name: UTF-8>
+        <number of versions: uint32>
+        for each version:
+            <timestamp: int64> <number of lines: uint32>
+            <line numbers: uint32 each>
+
+The history usually has many versions of the same item which differ by
+a few lines, so each distinct line is stored only once and the values
+refer to them by their line numbers.  This makes the payload small and
+fast to decode, and the loaded values share the line objects.  Since
+the lines are joined with newlines, the lines cannot contain newlines
+themselves.  This holds for the values stored by `Storage`, which
+splits the values to lines.
+"""
+import gzip
+import io
+import struct
+import sys
+import zlib
+from array import array
+from typing import (IO, Any, Dict, Iterable, Iterator, List, Sequence, Tuple,
+                    Union)
+
+MAGIC = b'PEPUBOT-SNAPSHOT 1\n'
+
+_HEADER = struct.Struct('<4sI')
+_COUNT = struct.Struct('<I')
+_LINES = struct.Struct('<II')
+_VERSION = struct.Struct('<qI')
+_LINE_NUMBER_TYPE = 'I'  # uint32 on the supported platforms
+
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 9
+
+#: Stream of the compressed or the uncompressed payload
+_Stream = Union[IO[bytes], gzip.GzipFile]
+
+#: Items of the file: [(name, [(timestamp, value lines), ...]), ...]
+Items = Iterable[Tuple[str, Iterable[Tuple[int, Sequence[str]]]]]
+
+
+def is_snapshot_file(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read(fp: IO[bytes]) -> Iterator[Tuple[str, Iterator[
+        Tuple[int, List[str]]]]]:
+    """
+    Read the items from a snapshot file.
+
+    The payload is decompressed incrementally, so only the distinct
+    lines are kept in memory.  Each item must be iterated completely
+    before the next one.  The checksum is verified after the last item,
+    so a ValueError is raised at the end of the iteration if the file
+    is corrupted.
+    """
+    (codec, checksum) = _read_header(fp)
+    return _read_payload(_open_decompressor(codec, fp), checksum)
+
+
+def read_all(data: bytes) -> List[Tuple[str, List[Tuple[int, List[str]]]]]:
+    """
+    Read all items from the contents of a snapshot file.
+
+    The payload is decompressed at once, which is faster than
+    decompressing it incrementally.
+    """
+    fp = io.BytesIO(data)
+    (codec, checksum) = _read_header(fp)
+    payload = _decompress(codec, data[fp.tell():])
+    return [(name, list(versions)) for (name, versions) in _read_payload(
+        io.BytesIO(payload), checksum)]
+
+
+def write(fp: IO[bytes], items: Items) -> None:
+    """
+    Write given items to a file in the snapshot format.
+    """
+    line_numbers: Dict[str, int] = {}
+    chunks: List[bytes] = []
+    items = list(items)
+    chunks.append(_COUNT.pack(len(items)))
+    for (name, versions) in items:
+        encoded_name = name.encode('utf-8')
+        versions = list(versions)
+        chunks.append(_COUNT.pack(len(encoded_name)))
+        chunks.append(encoded_name)
+        chunks.append(_COUNT.pack(len(versions)))
+        for (timestamp, value) in versions:
+            numbers = array(_LINE_NUMBER_TYPE, [
+                line_numbers.setdefault(x, len(line_numbers))
+                for x in value])
+            if sys.byteorder == 'big':
+                numbers.byteswap()
+            chunks.append(_VERSION.pack(timestamp, len(numbers)))
+            chunks.append(numbers.tobytes())
+    joined_lines = '\n'.join(line_numbers)
+    if joined_lines.count('\n') != max(len(line_numbers) - 1, 0):
+        raise ValueError('Lines of a value cannot contain newlines')
+    encoded_lines = joined_lines.encode('utf-8')
+    chunks[:0] = [
+        _LINES.pack(len(line_numbers), len(encoded_lines)), encoded_lines]
+    payload = b''.join(chunks)
+    (codec, compressed) = _compress(payload)
+    fp.write(MAGIC)
+    fp.write(_HEADER.pack(codec, zlib.crc32(payload)))
+    fp.write(compressed)
+
+
+def _read_header(fp: IO[bytes]) -> Tuple[bytes, int]:
+    if not is_snapshot_file(fp.read(len(MAGIC))):
+        raise ValueError('Not a snapshot storage file')
+    (codec, checksum) = _HEADER.unpack(_read_exactly(fp, _HEADER.size))
+    return (codec, checksum)
+
+
+def _read_payload(
+        fp: _Stream,
+        checksum: int,
+) -> Iterator[Tuple[str, Iterator[Tuple[int, List[str]]]]]:
+    reader = _ChecksummingReader(fp)
+    (line_count, length) = _LINES.unpack(reader.read(_LINES.size))
+    lines = reader.read(length).decode('utf-8').split('\n')
+    if len(lines) != max(line_count, 1):
+        raise ValueError('Snapshot storage file has corrupted lines')
+    (item_count,) = _COUNT.unpack(reader.read(_COUNT.size))
+    for _n in range(item_count):
+        (name_length,) = _COUNT.unpack(reader.read(_COUNT.size))
+        name = reader.read(name_length).decode('utf-8')
+        (version_count,) = _COUNT.unpack(reader.read(_COUNT.size))
+        versions = _read_versions(reader, version_count, lines)
+        yield (name, versions)
+        for _version in versions:  # Skip the ones not iterated
+            pass
+    if reader.read_remaining():
+        raise ValueError('Snapshot storage file has extra data')
+    if reader.checksum != checksum:
+        raise ValueError('Snapshot storage file checksum does not match')
+
+
+def _read_versions(
+        reader: '_ChecksummingReader',
+        count: int,
+        lines: Sequence[str],
+) -> Iterator[Tuple[int, List[str]]]:
+    for _n in range(count):
+        (timestamp, line_count) = _VERSION.unpack(reader.read(_VERSION.size))
+        numbers = array(_LINE_NUMBER_TYPE)
+        numbers.frombytes(reader.read(line_count * numbers.itemsize))
+        if sys.byteorder == 'big':
+            numbers.byteswap()
+        try:
+            value = list(map(lines.__getitem__, numbers))
+        except IndexError:
+            raise ValueError('Snapshot storage file has a corrupted value')
+        yield (timestamp, value)
+
+
+def _compress(payload: bytes) -> Tuple[bytes, bytes]:
+    try:
+        import zstandard
+    except ImportError:
+        return (b'gzip', gzip.compress(payload, _GZIP_LEVEL, mtime=0))
+    compressor = zstandard.ZstdCompressor(level=_ZSTD_LEVEL)
+    return (b'zstd', compressor.compress(payload))
+
+
+def _decompress(codec: bytes, data: bytes) -> bytes:
+    if codec == b'gzip':
+        return gzip.decompress(data)
+    elif codec == b'zstd':
+        zstandard = _import_zstandard()
+        # Not all versions of zstandard record the content size
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        result: bytes = decompressor.decompress(data)
+        return result
+    raise ValueError(f'Unknown snapshot compression: {codec!r}')
+
+
+def _open_decompressor(codec: bytes, fp: IO[bytes]) -> _Stream:
+    if codec == b'gzip':
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    elif codec == b'zstd':
+        zstandard = _import_zstandard()
+        reader: IO[bytes] = zstandard.ZstdDecompressor().stream_reader(fp)
+        return reader
+    raise ValueError(f'Unknown snapshot compression: {codec!r}')
+
+
+def _import_zstandard() -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            'Reading a zstd compressed storage file needs zstandard '
+            '(pip install pepubot[zstd])')
+    return zstandard
+
+
+def _read_exactly(fp: _Stream, size: int) -> bytes:
+    data = fp.read(size)
+    while len(data) < size:  # Decompressors may return less
+        more = fp.read(size - len(data))
+        if not more:
+            raise ValueError('Snapshot storage file is truncated')
+        data += more
+    return data
+
+
+class _ChecksummingReader:
+    def __init__(self, fp: _Stream) -> None:
+        self.fp = fp
+        self.checksum = 0
+
+    def read(self, size: int) -> bytes:
+        data = _read_exactly(self.fp, size) if size else b''
+        self.checksum = zlib.crc32(data, self.checksum)
+        return data
+
+    def read_remaining(self) -> bytes:
+        data = self.fp.read()
+        self.checksum = zlib.crc32(data, self.checksum)
+        return data
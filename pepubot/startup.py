@@ -0,0 +1,141 @@
+"""
+Startup time measurements.
+
+The bot should be ready to handle events soon after its container has
+started.  The functions in here measure how long importing each module
+and initializing each of the cached global objects takes, so that the
+startup cost can be reported with ``pepubot --startup-report`` and kept
+within `STARTUP_BUDGET` by the tests.
+"""
+import asyncio
+import importlib
+import time
+from typing import (TYPE_CHECKING, Any, Callable, Coroutine, List, NamedTuple,
+                    Sequence, TextIO, Tuple, TypeVar)
+
+if TYPE_CHECKING:
+    import aiohttp
+
+    from .settings import Settings
+
+T = TypeVar('T')
+
+#: Maximum time (in seconds) allowed from process start to the point
+#: where the bot is ready to connect to Slack and handle events.  The
+#: startup takes about 0.3 seconds, most of it importing slack, so this
+#: leaves a margin of about 70% for slower machines.
+STARTUP_BUDGET = 0.5
+
+#: Modules needed for handling events, in the order they are imported.
+#: Third party modules come first, so that the time spent in them is
+#: not attributed to the PePuBot modules importing them.
+STARTUP_MODULES = [
+    'pytz',
+    'slack',
+    'pepubot.settings',
+    'pepubot.storage',
+    'pepubot.times',
+    'pepubot.messages',
+    'pepubot.hashing',
+    'pepubot.lottery_box',
+    'pepubot.userinfo',
+    'pepubot.runner',
+    'pepubot.ingestion',
+    'pepubot.caching_client',
+    'pepubot.slack',
+    'pepubot.workspace',
+]
+
+
+class StartupTiming(NamedTuple):
+    name: str
+    seconds: float
+
+
+def measure_startup(settings_file: str) -> List[StartupTiming]:
+    """
+    Import the modules and initialize the objects needed for handling events.
+
+    Return the time spent in each step.  Note that the import timings
+    are only meaningful when measured in a fresh process, since modules
+    which are already imported are not imported again.
+    """
+    from .settings import initialize_settings
+
+    timings = [
+        _timed(f'import {name}', importlib.import_module, name)
+        for name in STARTUP_MODULES]
+
+    from .storage import get_default_storage
+    from .times import get_default_timezone
+    from .workspace import create_http_session
+
+    (timing, settings) = _timed_result(
+        'init settings', initialize_settings, settings_file)
+    timings.append(timing)
+    timings.append(_timed('init timezone', get_default_timezone))
+    timings.append(_timed(
+        'init storage', _run, get_default_storage()._get_data))
+    (timing, session) = _timed_result(
+        'init http session', _run, create_http_session)
+    timings.append(timing)
+    try:
+        timings.append(_timed(
+            'init workspace', _run,
+            lambda: _set_up_workspace(settings, session)))
+    finally:
+        _run(session.close)
+    return timings
+
+
+def print_startup_report(
+        timings: Sequence[StartupTiming],
+        output: TextIO,
+) -> None:
+    total = sum(x.seconds for x in timings)
+    width = max(len(x.name) for x in timings)
+    for timing in timings:
+        print(f'{timing.name:{width}} {timing.seconds * 1000:9.1f} ms',
+              file=output)
+    print(f'{"total":{width}} {total * 1000:9.1f} ms '
+          f'(budget {STARTUP_BUDGET * 1000:.0f} ms)', file=output)
+
+
+async def _set_up_workspace(
+        settings: 'Settings',
+        session: 'aiohttp.ClientSession',
+) -> None:
+    """
+    Set up a workspace like it is done on start, but without networking.
+
+    The team id would be asked from Slack, so a made up team id is used
+    instead.  This also keeps the event queue from handling the events
+    spilled by the bot.
+    """
+    from .workspace import Workspace
+
+    token = settings.get_api_tokens()[0]
+    workspace_settings = settings.for_workspace(token, 'TSTARTUP')
+    Workspace(workspace_settings, session)._set_up()
+
+
+def _timed(
+        name: str,
+        func: Callable[..., object],
+        *args: object,
+) -> StartupTiming:
+    return _timed_result(name, func, *args)[0]
+
+
+def _timed_result(
+        name: str,
+        func: Callable[..., T],
+        *args: object,
+) -> Tuple[StartupTiming, T]:
+    start = time.perf_counter()
+    result = func(*args)
+    return (StartupTiming(name, time.perf_counter() - start), result)
+
+
+def _run(coroutine_func: Callable[[], Coroutine[Any, Any, T]]) -> T:
+    return asyncio.get_event_loop().run_until_complete(coroutine_func())
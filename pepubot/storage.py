@@ -1,20 +1,33 @@
 import asyncio
+import io
 import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
 import time
-from typing import Dict, List, NamedTuple, Optional, Sequence
-
-import aiofiles
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import (IO, Dict, Iterator, List, NamedTuple, Optional, Sequence,
+                    TextIO, Tuple)
 
+from . import indexed_file, snapshot_file
 from .settings import get_settings
 
-_default_storage: Optional['Storage'] = None
+_default_storages: Dict[str, 'Storage'] = {}
 
 
 def get_default_storage() -> 'Storage':
-    global _default_storage
-    if _default_storage is None:
-        _default_storage = Storage(get_settings().STORAGE_FILE)
-    return _default_storage
+    settings = get_settings()  # Per workspace, when serving many
+    storage = _default_storages.get(settings.STORAGE_FILE)
+    if storage is None:
+        storage = _default_storages[settings.STORAGE_FILE] = Storage(
+            settings.STORAGE_FILE,
+            file_format=settings.STORAGE_FORMAT,
+            memory_limit=int(settings.STORAGE_MEMORY_LIMIT))
+    return storage
 
 
 class Version(NamedTuple):
@@ -24,14 +37,31 @@ class Version(NamedTuple):
 
 DataDict = Dict[str, List[Version]]
 
-_load_cache: Dict[str, DataDict] = {}
+#: Items read from a storage file and the memory-mapped file, if any
+_FileContents = Tuple[Dict[str, List['_Slot']], Optional[mmap.mmap]]
+
+FILE_FORMATS = ['json', 'compact-json', 'indexed', 'snapshot']
+
+DEFAULT_MEMORY_LIMIT = 4 * 1024 * 1024  # bytes
+
+_load_cache: Dict[str, '_LoadedData'] = {}
 _load_lock = asyncio.Lock()
 
 
 class Storage:
-    def __init__(self, filename: str) -> None:
+    def __init__(
+            self,
+            filename: str,
+            *,
+            file_format: str = 'json',
+            memory_limit: int = DEFAULT_MEMORY_LIMIT,
+    ) -> None:
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f'Unknown storage file format: {file_format}')
         self.filename: str = filename
-        self._data: Optional[DataDict] = None
+        self.file_format: str = file_format
+        self.memory_limit: int = memory_limit
+        self._data: Optional[_LoadedData] = None
 
     async def store_item(
             self, name: str,
@@ -39,47 +69,144 @@ class Storage:
             *,
             add_new_version: bool = False,
     ) -> None:
-        versions: List[Version] = (await self._get_data()).setdefault(name, [])
+        data = await self._get_data()
+        versions = data.items.setdefault(name, [])
         if not add_new_version and versions:
-            versions.pop()  # Remove the last version
-        versions.append(Version(time.time_ns(), value.split('\n')))
+            data.forget(versions.pop())  # Remove the last version
+        if versions:
+            data.make_cold(versions[-1])
+        versions.append(_Slot(time.time_ns(), value.split('\n')))
         await self._save()
 
     async def get_item(self, name: str) -> Optional[str]:
-        versions = (await self._get_data()).get(name, [])
-        return '\n'.join(versions[-1].value) if versions else None
+        data = await self._get_data()
+        versions = data.items.get(name, [])
+        return '\n'.join(data.get_value(versions[-1])) if versions else None
 
     async def get_all_versions(self, name: str) -> Sequence[Version]:
-        return (await self._get_data()).get(name, []).copy()
+        data = await self._get_data()
+        versions = data.items.get(name, [])
+        result = [Version(x.timestamp, data.get_value(x)) for x in versions]
+        for slot in versions[:-1]:
+            data.make_cold(slot)
+        return result
 
-    async def _get_data(self) -> DataDict:
+    async def _get_data(self) -> '_LoadedData':
         if self._data is None:
             self._data = await self._load()
         return self._data
 
-    async def _load(self) -> DataDict:
+    async def _load(self) -> '_LoadedData':
         cached = _load_cache.get(self.filename)
         if cached:
             return cached
         async with _load_lock:
             if self.filename in _load_cache:  # Re-check while locked
                 return _load_cache[self.filename]
-            try:
-                async with aiofiles.open(
-                        self.filename, 'rt', encoding='utf-8') as fp:
-                    data = json.loads(await fp.read())
-            except FileNotFoundError:
-                result: DataDict = {}
-            else:
-                result = self._convert_data_type(data)
+            result = await self._read_data()
             _load_cache[self.filename] = result
         return result
 
+    async def _read_data(self) -> '_LoadedData':
+        loop = asyncio.get_running_loop()
+        (items, buffer) = await loop.run_in_executor(None, self._read_file)
+        # Created in the event loop thread, since the lock of the loaded
+        # data binds to the event loop of the current thread on Python 3.7
+        return _LoadedData(items, buffer, self.memory_limit)
+
+    def _read_file(self) -> '_FileContents':
+        try:
+            fp = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return ({}, None)
+        with fp:
+            if fp.read(len(indexed_file.MAGIC)) == indexed_file.MAGIC:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                return (_read_indexed_items(buffer), buffer)
+            fp.seek(0)
+            contents = fp.read()
+        if snapshot_file.is_snapshot_file(contents):
+            return ({
+                name: [_Slot(ts, value) for (ts, value) in versions]
+                for (name, versions) in snapshot_file.read_all(contents)
+            }, None)
+        data = self._convert_data_type(json.loads(contents))
+        return ({
+            name: [_Slot(x.timestamp, list(x.value)) for x in versions]
+            for (name, versions) in data.items()
+        }, None)
+
     async def _save(self) -> None:
-        async with aiofiles.open(self.filename, 'wt', encoding='utf-8') as fp:
-            encoder = json.JSONEncoder(ensure_ascii=False, indent=2)
-            for chunk in encoder.iterencode(self._data):
-                await fp.write(chunk)
+        data = await self._get_data()
+        async with data.save_lock:
+            if self.file_format == 'indexed':
+                await self._save_indexed(data)
+            elif self.file_format == 'snapshot':
+                await self._save_snapshot(data)
+            else:
+                await self._save_json(data)
+
+    async def _save_json(self, data: '_LoadedData') -> None:
+        data.replace_buffer(None, [])  # Load everything before overwriting
+        to_save = {
+            name: [[x.timestamp, data.get_value(x)] for x in versions]
+            for (name, versions) in data.items.items()}
+        compact = (self.file_format == 'compact-json')
+
+        def write_file() -> None:
+            encoded = _encode_json(to_save, compact=compact)
+            with _atomic_file(self.filename) as fp:
+                fp.write(encoded)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_file)
+
+    async def _save_snapshot(self, data: '_LoadedData') -> None:
+        data.replace_buffer(None, [])  # Load everything before overwriting
+        to_save = [
+            (name, [(x.timestamp, data.get_value(x)) for x in versions])
+            for (name, versions) in data.items.items()]
+
+        def write_file() -> None:
+            with _atomic_file(self.filename) as fp:
+                snapshot_file.write(fp, to_save)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_file)
+
+    async def _save_indexed(self, data: '_LoadedData') -> None:
+        snapshot = [
+            (name, [(x, x.timestamp, x.value, x.location) for x in versions])
+            for (name, versions) in data.items.items()]
+        old_buffer = data.buffer
+
+        def encode_items() -> Iterator[
+                Tuple[str, Iterator[Tuple[int, bytes]]]]:
+            for (name, versions) in snapshot:
+                yield (name, (
+                    (timestamp, indexed_file.encode_value(value)
+                     if value is not None else _read_raw(location))
+                    for (_slot, timestamp, value, location) in versions))
+
+        def _read_raw(location: Optional[indexed_file.Location]) -> bytes:
+            assert old_buffer is not None and location is not None
+            (offset, length) = location
+            return old_buffer[offset:offset + length]
+
+        def write_file() -> Tuple[mmap.mmap, indexed_file.Index]:
+            with _atomic_file(self.filename) as fp:
+                index = indexed_file.write(fp, encode_items())
+            with open(self.filename, 'rb') as fp:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            return (buffer, index)
+
+        loop = asyncio.get_running_loop()
+        (buffer, index) = await loop.run_in_executor(None, write_file)
+        locations: List[Tuple[_Slot, indexed_file.Location]] = []
+        for (name, versions) in snapshot:
+            slots = (slot for (slot, _ts, _value, _location) in versions)
+            locations.extend(zip(slots, (x for (_ts, x) in index[name])))
+        data.replace_buffer(buffer, locations)
 
     @classmethod
     def _convert_data_type(cls, data: object) -> DataDict:
@@ -92,14 +219,304 @@ class Storage:
             if not isinstance(versions, list):
                 raise TypeError('Each name should contain a list of versions')
             for (n, version) in enumerate(versions):
-                if not isinstance(version, (list, tuple)) or len(version) != 2:
-                    raise TypeError('Each version should be a pair')
-                (timestamp, value) = version
-                if not isinstance(timestamp, int):
-                    raise TypeError('First item of pair should be an integer')
-                if not isinstance(value, list):
-                    raise TypeError('Second item of pair should be a list')
-                if not all(isinstance(x, str) for x in value):
-                    raise TypeError('Each value should be a list of strings')
-                versions[n] = Version(timestamp, value)
+                versions[n] = _convert_version(version)
         return data
+
+
+async def convert_file(
+        source: str,
+        target: str,
+        file_format: str,
+) -> None:
+    """
+    Convert a storage file in any format to given format.
+
+    The source and the target may be the same file.
+    """
+    storage = Storage(target, file_format=file_format)
+    storage._data = await Storage(source)._read_data()
+    await storage._save()
+
+
+def iter_file_versions(filename: str) -> Iterator[Tuple[str, Version]]:
+    """
+    Iterate all versions of all items in given storage file.
+
+    The file is read incrementally, so that the memory used does not
+    depend on the size of the file.  The versions of each item are
+    iterated from the oldest to the newest.
+    """
+    with open(filename, 'rb') as fp:
+        if fp.read(len(indexed_file.MAGIC)) == indexed_file.MAGIC:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for (name, entries) in indexed_file.read_index(buf).items():
+                    for (timestamp, location) in entries:
+                        value = indexed_file.read_value(buf, location)
+                        yield (name, Version(timestamp, value))
+            return
+        fp.seek(0)
+        if snapshot_file.is_snapshot_file(fp.read(len(snapshot_file.MAGIC))):
+            fp.seek(0)
+            for (name, versions) in snapshot_file.read(fp):
+                for (timestamp, value) in versions:
+                    yield (name, Version(timestamp, value))
+            return
+        fp.seek(0)
+        yield from _iter_json_versions(io.TextIOWrapper(fp, encoding='utf-8'))
+
+
+def _iter_json_versions(fp: TextIO) -> Iterator[Tuple[str, Version]]:
+    reader = _JsonStreamReader(fp)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.decode()
+        if not isinstance(name, str):
+            raise TypeError('Name of each item should be a string')
+        reader.expect(':')
+        reader.expect('[')
+        if reader.peek() == ']':
+            reader.expect(']')
+        else:
+            while True:
+                yield (name, _convert_version(reader.decode()))
+                if reader.expect(',]') == ']':
+                    break
+        if reader.expect(',}') == '}':
+            return
+
+
+class _JsonStreamReader:
+    """
+    Reader of JSON values from a stream, one value at a time.
+
+    Only strings, lists and dicts can be decoded, since they have a
+    closing delimiter and so it's known when they are read completely.
+    """
+    def __init__(self, fp: TextIO, chunk_size: int = 1024 * 1024) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def peek(self) -> str:
+        """
+        Get the next non-whitespace character without consuming it.
+
+        Return an empty string at the end of the stream.
+        """
+        while True:
+            match = _WHITESPACE_RX.match(self._buffer, self._pos)
+            self._pos = match.end() if match else self._pos
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read_more():
+                return ''
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                f'Expected one of {chars!r} in storage file, got {char!r}')
+        self._pos += 1
+        return char
+
+    def decode(self) -> object:
+        self.peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(
+                    self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+            else:
+                self._pos = end
+                return value
+
+    def _read_more(self) -> bool:
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+
+_WHITESPACE_RX = re.compile(r'\s*')
+
+
+def _convert_version(version: object) -> Version:
+    if not isinstance(version, (list, tuple)) or len(version) != 2:
+        raise TypeError('Each version should be a pair')
+    (timestamp, value) = version
+    if not isinstance(timestamp, int):
+        raise TypeError('First item of pair should be an integer')
+    if not isinstance(value, list):
+        raise TypeError('Second item of pair should be a list')
+    if not all(isinstance(x, str) for x in value):
+        raise TypeError('Each value should be a list of strings')
+    return Version(timestamp, value)
+
+
+def _encode_json(data: object, *, compact: bool = False) -> bytes:
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(
+            data, ensure_ascii=False, indent=(None if compact else 2),
+            separators=((',', ':') if compact else (',', ': ')),
+        ).encode('utf-8')
+    return orjson.dumps(data, option=(0 if compact else orjson.OPT_INDENT_2))
+
+
+def _get_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read only once, since it cannot be read without setting it and the
+# files are written from executor threads
+_UMASK = _get_umask()
+
+
+@contextmanager
+def _atomic_file(filename: str) -> Iterator[IO[bytes]]:
+    """
+    Open a temporary file to be renamed to given filename when complete.
+
+    This way the file is never left partially written.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.pepubot-', delete=False) as fp:
+        try:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+            if os.path.exists(filename):
+                shutil.copymode(filename, fp.name)
+            else:  # Use the mode of files created with open()
+                os.chmod(fp.name, 0o666 & ~_UMASK)
+            os.replace(fp.name, filename)
+        except BaseException:
+            os.unlink(fp.name)
+            raise
+
+
+@dataclass(eq=False)
+class _Slot:
+    """
+    Storage slot of a single version.
+
+    The value of the slot is either decoded in memory or only present
+    in the storage file at the given location, or both.
+    """
+    timestamp: int
+    value: Optional[List[str]] = None
+    location: Optional[indexed_file.Location] = None
+
+
+def _read_indexed_items(buffer: mmap.mmap) -> Dict[str, List[_Slot]]:
+    """
+    Read the items of an indexed file with only the latest values decoded.
+    """
+    items = {
+        name: [_Slot(ts, location=location) for (ts, location) in entries]
+        for (name, entries) in indexed_file.read_index(buffer).items()}
+    for versions in items.values():
+        if versions:
+            slot = versions[-1]
+            assert slot.location is not None
+            slot.value = indexed_file.read_value(buffer, slot.location)
+    return items
+
+
+class _LoadedData:
+    """
+    Loaded contents of a storage file.
+
+    Only the values of the latest versions are kept in memory
+    permanently.  Values of the older versions, i.e. the cold ones, are
+    decoded from the storage file when needed and evicted in least
+    recently used order when their total size exceeds the memory limit.
+    """
+    def __init__(
+            self,
+            items: Dict[str, List[_Slot]],
+            buffer: Optional[mmap.mmap],
+            memory_limit: int,
+    ) -> None:
+        self.items = items
+        self.buffer = buffer
+        self.memory_limit = memory_limit
+        self.save_lock = asyncio.Lock()
+        self._cold: 'OrderedDict[_Slot, int]' = OrderedDict()
+        self._cold_size = 0
+
+    @property
+    def cold_size(self) -> int:
+        return self._cold_size
+
+    def get_value(self, slot: _Slot) -> List[str]:
+        if slot.value is None:
+            assert self.buffer is not None and slot.location is not None
+            slot.value = indexed_file.read_value(self.buffer, slot.location)
+        elif slot in self._cold:
+            self._cold.move_to_end(slot)
+        return slot.value
+
+    def make_cold(self, slot: _Slot) -> None:
+        """
+        Mark the value of given slot evictable from memory.
+
+        Values which are not stored to the storage file yet cannot be
+        evicted, but they will be marked after the next save.
+        """
+        if slot.value is None or slot.location is None:
+            return
+        if slot in self._cold:
+            self._cold.move_to_end(slot)
+            return
+        size = slot.location[1]
+        self._cold[slot] = size
+        self._cold_size += size
+        while self._cold_size > self.memory_limit:
+            (evicted, evicted_size) = self._cold.popitem(last=False)
+            evicted.value = None
+            self._cold_size -= evicted_size
+
+    def forget(self, slot: _Slot) -> None:
+        size = self._cold.pop(slot, None)
+        if size is not None:
+            self._cold_size -= size
+
+    def replace_buffer(
+            self,
+            buffer: Optional[mmap.mmap],
+            locations: Sequence[Tuple[_Slot, indexed_file.Location]],
+    ) -> None:
+        """
+        Replace the storage file buffer after the file has been rewritten.
+
+        Values of the slots without a location in the new file are
+        kept in memory.
+        """
+        new_locations = dict(locations)
+        old_buffer = self.buffer
+        self._cold.clear()
+        self._cold_size = 0
+        for versions in self.items.values():
+            for slot in versions:
+                if slot.value is None and slot not in new_locations:
+                    self.get_value(slot)  # Still needed from old buffer
+                slot.location = new_locations.get(slot)
+        self.buffer = buffer
+        for versions in self.items.values():
+            for slot in versions[:-1]:
+                self.make_cold(slot)
+        if old_buffer is not None:
+            old_buffer.close()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+import os
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
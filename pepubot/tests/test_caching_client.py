@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from .. import caching_client as caching_client_module
+from ..caching_client import CachingWebClient
+from .conftest import run
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeWebClient:
+    def __init__(self, team_url='https://team.slack.com/'):
+        self.team_url = team_url
+        self.calls = Counter()
+
+    async def users_info(self, user):
+        self.calls['users_info'] += 1
+        await asyncio.sleep(0.01)
+        if user == 'UERROR':
+            raise RuntimeError('Failed')
+        return Response({'user': {'id': user, 'name': user.lower()}})
+
+    async def auth_test(self):
+        self.calls['auth_test'] += 1
+        if not self.team_url:
+            raise RuntimeError('Failed')
+        return Response({'url': self.team_url})
+
+    async def chat_getPermalink(self, channel, message_ts):
+        self.calls['chat_getPermalink'] += 1
+        return Response({'permalink': f'https://api/{channel}/{message_ts}'})
+
+    async def chat_postMessage(self, channel, text):
+        self.calls['chat_postMessage'] += 1
+
+
+def test_coalesces_and_memoizes_reads():
+    client = CachingWebClient(FakeWebClient())
+
+    async def fetch():
+        first = await asyncio.gather(*(
+            client.users_info(user=f'U{n % 2}') for n in range(10)))
+        second = await client.users_info(user='U0')
+        return (first, second)
+
+    (first, second) = run(fetch())
+
+    assert [x.data['user']['name'] for x in first[:2]] == ['u0', 'u1']
+    assert second is first[0]
+    assert client.client.calls['users_info'] == 2
+    stats = client.get_stats()['users_info']
+    assert (stats.hits, stats.coalesced, stats.misses) == (1, 8, 2)
+    assert stats.hit_rate == pytest.approx(9 / 11)
+
+
+def test_does_not_cache_errors_or_writes():
+    client = CachingWebClient(FakeWebClient())
+
+    async def fetch():
+        results = await asyncio.gather(*(
+            client.users_info(user='UERROR') for n in range(3)),
+            return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await client.users_info(user='UERROR')
+        await client.chat_postMessage(channel='C1', text='Hi')
+        await client.chat_postMessage(channel='C1', text='Hi')
+        return results
+
+    results = run(fetch())
+
+    assert all(isinstance(x, RuntimeError) for x in results)
+    assert client.client.calls == {'users_info': 2, 'chat_postMessage': 2}
+
+
+def test_expires_cached_responses():
+    client = CachingWebClient(FakeWebClient(), ttls={'users_info': 0})
+
+    run(client.users_info(user='U1'))
+    run(client.users_info(user='U1'))
+
+    assert client.client.calls['users_info'] == 2
+
+
+def test_prunes_expired_and_oldest_responses(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(caching_client_module, 'time', SimpleNamespace(
+        monotonic=lambda: now[0]))
+    client = CachingWebClient(
+        FakeWebClient(), ttls={'users_info': 10}, max_size=3)
+
+    for user in ['U1', 'U2', 'U3', 'U4']:
+        run(client.users_info(user=user))
+    assert client.get_cache_size() == 3
+    run(client.users_info(user='U2'))  # Still cached
+    assert client.client.calls['users_info'] == 4
+
+    now[0] += 11
+    run(client.users_info(user='U5'))
+
+    assert client.get_cache_size() == 1
+    assert str(client.get_stats()['users_info']) == (
+        'hit rate 16.7% (1 hits, 0 coalesced, 5 misses)')
+
+
+@pytest.mark.parametrize('team_url,expected', [
+    ('https://team.slack.com/', 'https://team.slack.com/archives/C1/p1234'),
+    ('', 'https://api/C1/12.34'),
+])
+def test_permalinks(team_url, expected):
+    client = CachingWebClient(FakeWebClient(team_url))
+
+    responses = [
+        run(client.chat_getPermalink(channel='C1', message_ts='12.34'))
+        for n in range(2)]
+
+    assert [x.data['permalink'] for x in responses] == [expected] * 2
+    assert client.client.calls['chat_getPermalink'] == (0 if team_url else 1)
+
+
+@pytest.mark.parametrize('ttls', [{}, {'users_info': 60}])
+def test_passes_through_methods_without_ttl(ttls):
+    client = CachingWebClient(FakeWebClient(), ttls=ttls)
+
+    responses = [
+        run(client.chat_getPermalink(channel='C1', message_ts='12.34'))
+        for n in range(2)]
+
+    assert [x.data['permalink'] for x in responses] == [
+        'https://api/C1/12.34'] * 2
+    assert client.client.calls == {'chat_getPermalink': 2}
+    assert client.get_stats() == {}
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from .. import storage as storage_module
+from ..export import iter_records, write_csv, write_ndjson
+from ..storage import Storage, _iter_json_versions, iter_file_versions
+
+BOX_VERSIONS = [
+    '   1 T00001 2019-10-04T16:00:00+03:00 C1 1570194000.000100 U1 alice\n'
+    '   2 T00002 2019-10-04T16:01:00+03:00 C1 1570194060.000200 U2 bob\n'
+    'next_ticket_number=3',
+    '   1 T00002 2019-10-04T16:01:00+03:00 C1 1570194060.000200 U2 bob\n'
+    'next_ticket_number=3',
+]
+
+
+@pytest.fixture(params=['json', 'indexed'])
+def storage_file(request, tmpdir):
+    storage = Storage(str(tmpdir.join('data')), file_format=request.param)
+
+    async def fill():
+        for value in BOX_VERSIONS:
+            await storage.store_item(
+                'lottery_box', value, add_new_version=True)
+        await storage.store_item('runner_state', 'not_started')
+
+    asyncio.get_event_loop().run_until_complete(fill())
+    storage_module._load_cache.pop(storage.filename)
+    return storage.filename
+
+
+def test_iter_records(storage_file):
+    records = list(iter_records(storage_file))
+
+    assert [
+        (x['record_type'], x['item'], x.get('ticket')) for x in records] == [
+        ('version', 'lottery_box', None),
+        ('ticket', 'lottery_box', 'T00001'),
+        ('ticket', 'lottery_box', 'T00002'),
+        ('version', 'lottery_box', None),
+        ('ticket', 'lottery_box', 'T00002'),
+        ('version', 'runner_state', None),
+    ]
+    assert records[2]['username'] == 'bob'
+    assert records[2]['position'] == 2
+    assert records[4]['position'] == 1
+    assert records[5]['value'] == 'not_started'
+
+
+def test_iter_records_filtered(storage_file):
+    versions = list(iter_file_versions(storage_file))
+    timestamps = [x.timestamp for (_name, x) in versions[:2]]
+    between = datetime.fromtimestamp(sum(timestamps) / 2e9, timezone.utc)
+
+    by_item = list(iter_records(storage_file, items=['runner_state']))
+    by_time = list(iter_records(storage_file, until=between))
+
+    assert [x['item'] for x in by_item] == ['runner_state']
+    assert [x.get('ticket') for x in by_time] == [None, 'T00001', 'T00002']
+
+
+def test_write_formats(storage_file):
+    ndjson_output = io.StringIO()
+    csv_output = io.StringIO()
+
+    write_ndjson(iter_records(storage_file), ndjson_output)
+    write_csv(iter_records(storage_file), csv_output)
+
+    from_ndjson = [
+        json.loads(x) for x in ndjson_output.getvalue().splitlines()]
+    from_csv = list(csv.DictReader(io.StringIO(csv_output.getvalue())))
+    assert len(from_ndjson) == len(from_csv) == 6
+    assert [x['ticket'] for x in from_csv] == [
+        '', 'T00001', 'T00002', '', 'T00002', '']
+    assert from_csv[1]['user_id'] == from_ndjson[1]['user_id'] == 'U1'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1024])
+def test_iter_json_versions_in_chunks(chunk_size, monkeypatch):
+    data = {'a': [[1, ['x', 'y']], [2, []]], 'b': [], 'c': [[3, ['ä']]]}
+    monkeypatch.setattr(
+        storage_module._JsonStreamReader.__init__, '__defaults__',
+        (chunk_size,))
+
+    result = list(_iter_json_versions(io.StringIO(json.dumps(data, indent=2))))
+
+    assert result == [
+        ('a', (1, ['x', 'y'])), ('a', (2, [])), ('c', (3, ['ä']))]
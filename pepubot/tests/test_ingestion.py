@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+import json
+import logging
+from types import SimpleNamespace
+
+from ..ingestion import EventQueue, OverflowPolicy
+from ..runner import PePuRunner
+from ..settings import Settings, use_workspace_settings
+from .conftest import run
+
+
+class RecordingHandler:
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, data):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.handled.append((data['channel'], data['n']))
+        self.running -= 1
+
+
+def is_chatter(data):
+    return data.get('chatter', False)
+
+
+def test_events_of_channel_are_handled_in_order():
+    handler = RecordingHandler()
+    queue = EventQueue(handler, max_workers=2)
+
+    async def feed():
+        for n in range(10):
+            for channel in ['C1', 'C2', 'C3']:
+                await queue.put({'channel': channel, 'n': n})
+        await queue.drain()
+
+    run(feed())
+
+    assert len(handler.handled) == 30
+    assert handler.max_running == 2
+    for channel in ['C1', 'C2', 'C3']:
+        assert [n for (ch, n) in handler.handled if ch == channel] == (
+            list(range(10)))
+    assert queue.get_stats().handled == 30
+    assert queue.get_stats().lag == 0.0
+
+
+def test_block_policy_limits_queue_size():
+    handler = RecordingHandler()
+    queue = EventQueue(handler, max_size=3)
+    sizes = []
+
+    async def feed():
+        for n in range(10):
+            await queue.put({'channel': 'C1', 'n': n})
+            sizes.append(queue.get_stats().queued)
+        await queue.drain()
+
+    run(feed())
+
+    assert max(sizes) == 3
+    assert [n for (_ch, n) in handler.handled] == list(range(10))
+
+
+def test_drop_ignorable_policy_drops_chatter_first():
+    handler = RecordingHandler()
+    queue = EventQueue(
+        handler, max_size=3, is_ignorable=is_chatter,
+        overflow_policy=OverflowPolicy.drop_ignorable)
+
+    async def feed():
+        await queue.put({'channel': 'C1', 'n': 0})
+        await queue.put({'channel': 'C1', 'n': 1, 'chatter': True})
+        await queue.put({'channel': 'C1', 'n': 2})
+        await queue.put({'channel': 'C1', 'n': 3})  # Drops 1
+        await queue.put({'channel': 'C1', 'n': 4, 'chatter': True})  # Dropped
+        await queue.drain()
+
+    run(feed())
+
+    assert [n for (_ch, n) in handler.handled] == [0, 2, 3]
+    assert queue.get_stats().dropped == 2
+
+
+def test_spill_policy_keeps_all_events_in_order(tmpdir):
+    spill_file = tmpdir.join('spill.jsonl')
+    handler = RecordingHandler()
+    queue = EventQueue(
+        handler, max_size=2, overflow_policy=OverflowPolicy.spill,
+        spill_file=str(spill_file))
+    spilled = []
+
+    async def feed():
+        for n in range(10):
+            await queue.put({'channel': f'C{n % 2}', 'n': n})
+            spilled.append(queue.get_stats().spilled)
+        await queue.drain()
+
+    run(feed())
+
+    assert max(spilled) == 8
+    assert sorted(n for (_ch, n) in handler.handled) == list(range(10))
+    assert [n for (ch, n) in handler.handled if ch == 'C0'] == [0, 2, 4, 6, 8]
+    assert not spill_file.exists()
+
+
+def test_spill_policy_skips_bad_spill_lines(tmpdir):
+    spill_file = tmpdir.join('spill.jsonl')
+    spill_file.write('\n'.join([
+        json.dumps({'received_at': 1.0, 'data': {'channel': 'C1', 'n': 0}}),
+        '{"received_at": 2.0, "data": {"chan',  # Partially written
+        json.dumps({'received_at': 3.0, 'data': {'channel': 'C1', 'n': 1}}),
+        json.dumps({'received_at': 4.0}),
+    ]) + '\n')
+    handler = RecordingHandler()
+    queue = EventQueue(
+        handler, max_size=1, overflow_policy=OverflowPolicy.spill,
+        spill_file=str(spill_file))
+
+    async def feed():
+        await queue.put({'channel': 'C1', 'n': 2})
+        await asyncio.wait_for(queue.drain(), 5)
+
+    run(feed())
+
+    assert handler.handled == [('C1', 0), ('C1', 1), ('C1', 2)]
+    assert queue.get_stats().spilled == 0
+    assert not spill_file.exists()
+
+
+def test_spill_policy_handles_events_left_by_previous_process(tmpdir):
+    spill_file = tmpdir.join('spill.jsonl')
+    spill_file.write(''.join(
+        json.dumps({'received_at': 1.0, 'data': {'channel': 'C1', 'n': n}})
+        + '\n' for n in range(3)))
+    handler = RecordingHandler()
+    queue = EventQueue(
+        handler, max_size=1, overflow_policy=OverflowPolicy.spill,
+        spill_file=str(spill_file))
+
+    async def wait_for_handled():
+        while len(handler.handled) < 3:
+            await asyncio.sleep(0.01)
+
+    run(asyncio.wait_for(wait_for_handled(), 5))
+
+    assert handler.handled == [('C1', 0), ('C1', 1), ('C1', 2)]
+    assert queue.get_stats().spilled == 0
+    assert not spill_file.exists()
+
+
+def test_spill_policy_handles_truncated_spill_file(tmpdir):
+    spill_file = tmpdir.join('spill.jsonl')
+    handler = RecordingHandler()
+    queue = EventQueue(
+        handler, max_size=1, overflow_policy=OverflowPolicy.spill,
+        spill_file=str(spill_file))
+
+    async def feed():
+        for n in range(3):
+            await queue.put({'channel': 'C1', 'n': n})
+        spill_file.write('')  # Lost the spilled events
+        await queue.put({'channel': 'C2', 'n': 3})
+        await asyncio.wait_for(queue.drain(), 5)
+
+    run(feed())
+
+    assert handler.handled == [('C1', 0), ('C2', 3)]
+    assert queue.get_stats() == (0, 0, 0, 2, 0.0)
+
+
+def test_stopped_worker_releases_its_channel():
+    async def handler(data):
+        await asyncio.sleep(10)
+
+    queue = EventQueue(handler)
+
+    async def feed():
+        for n in range(3):
+            await queue.put({'channel': 'C1', 'n': n})
+        await asyncio.sleep(0)
+        for worker in list(queue._workers):
+            worker.cancel()
+        await asyncio.wait_for(queue.drain(), 5)
+
+    run(feed())
+
+    assert queue.get_stats().queued == 0
+    assert queue.get_stats().dropped == 3
+
+
+class FakeWebClient:
+    def __init__(self):
+        self.messages = []
+
+    async def chat_postMessage(self, *, channel, text):
+        await asyncio.sleep(0.01)  # Let the other channels proceed
+        self.messages.append((channel, text))
+
+    async def users_info(self, *, user):
+        return SimpleNamespace(data={'user': {'name': f'name-{user}'}})
+
+    async def reactions_add(self, *, name, channel, timestamp):
+        pass
+
+    async def chat_getPermalink(self, *, channel, message_ts):
+        return SimpleNamespace(data={'permalink': f'{channel}/{message_ts}'})
+
+
+def test_runners_of_two_channels_share_the_state(tmpdir, caplog):
+    settings = Settings(str(tmpdir.join('nonexisting.conf')), {
+        'STORAGE_FILE': str(tmpdir.join('data.json'))})
+    client = FakeWebClient()
+    queue = EventQueue(
+        lambda x: PePuRunner(client).feed_message(x), max_workers=2)
+
+    async def feed():
+        use_workspace_settings(settings)
+        for (n, channel) in enumerate(['CA', 'CB']):
+            await queue.put({
+                'type': 'message', 'channel': channel, 'user': f'U{n}',
+                'ts': f'1570000000.00000{n}', 'text': 'pepu open'})
+        await queue.drain()
+
+    with caplog.at_level(logging.ERROR):
+        run(feed())
+
+    assert caplog.records == []
+    assert client.messages == [
+        ('CA', 'PePu is on!'),
+        ('CB', 'Sorry! Currently running PePu on another channel.')]
+
+
+def test_drumroll_does_not_block_other_channels(tmpdir, caplog):
+    settings = Settings(str(tmpdir.join('nonexisting.conf')), {
+        'STORAGE_FILE': str(tmpdir.join('data.json')),
+        'DRUMROLL_DURATION': '1'})
+    client = FakeWebClient()
+    queue = EventQueue(
+        lambda x: PePuRunner(client).feed_message(x), max_workers=2)
+    image = {'image_url': 'https://example.com/a.png'}
+
+    async def feed():
+        use_workspace_settings(settings)
+        for (n, (channel, text, extra)) in enumerate([
+                ('CA', 'pepu open', {}),
+                ('CA', 'look', {'attachments': [image]}),
+                ('CA', 'pepu end', {}),
+                ('CA', '1', {})]):
+            await queue.put(dict({
+                'type': 'message', 'channel': channel, 'user': 'U1',
+                'ts': f'1570000000.00000{n}', 'text': text}, **extra))
+        while not any(x.startswith('Winning ticket') for (_c, x) in (
+                client.messages)):
+            await asyncio.sleep(0.01)
+        await queue.put({
+            'type': 'message', 'channel': 'CB', 'user': 'U2',
+            'ts': '1570000000.000009', 'text': 'pepu open'})
+        await queue.drain()
+
+    with caplog.at_level(logging.ERROR):
+        run(feed())
+
+    assert caplog.records == []
+    texts = [x for (_channel, x) in client.messages]
+    sorry = 'Sorry! Currently running PePu on another channel.'
+    assert ('CB', sorry) in client.messages
+    assert texts.index(sorry) < texts.index('The winner is <@U1>! :tada:')
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+from ..load_test import run_load_test
+from .conftest import PROJECT_DIR, run
+
+
+def test_load_test(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', PROJECT_DIR)
+
+    report = run(run_load_test(
+        str(tmpdir), users=20, posts_per_user=2, seed=1, timeout=60))
+
+    assert report.violations == []
+    assert report.messages == 40
+    assert report.tickets == 20
+    assert report.winner is not None
+    assert report.api_calls['reactions.add'] == 40
+    assert report.api_calls['users.info'] == 20
+    assert 0 < report.latency_p50 <= report.latency_p99
+
+
+def test_load_test_with_errors(tmpdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', PROJECT_DIR)
+
+    report = run(run_load_test(
+        str(tmpdir), users=20, posts_per_user=2, error_rate=0.3, seed=1,
+        timeout=60))
+
+    assert report.violations == []
+    assert sum(report.api_errors.values()) > 0
+    assert report.tickets <= 20
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import os
+import subprocess
+import sys
+
+from ..startup import STARTUP_BUDGET
+from .conftest import PROJECT_DIR
+
+HEAVY_MODULES = ['slack', 'aiohttp', 'dateutil', 'pytz']
+
+
+def run_python(args, tmpdir):
+    env = dict(
+        os.environ,
+        PYTHONPATH=PROJECT_DIR,
+        SLACK_API_TOKEN='xoxb-test',
+        STORAGE_FILE=str(tmpdir.join('storage.json')),
+        TIMEZONE='Europe/Helsinki')
+    return subprocess.run(
+        [sys.executable] + args, env=env, cwd=str(tmpdir),
+        stdout=subprocess.PIPE, check=True, universal_newlines=True,
+        timeout=60).stdout
+
+
+def test_heavy_modules_are_not_imported_eagerly(tmpdir):
+    output = run_python([
+        '-c',
+        'import sys, pepubot.__main__;'
+        'import pepubot.runner, pepubot.storage, pepubot.lottery_box;'
+        'print(" ".join(sorted(sys.modules)))',
+    ], tmpdir)
+
+    imported = set(output.split())
+    assert [x for x in HEAVY_MODULES if x in imported] == []
+
+
+def test_startup_is_within_budget(tmpdir):
+    output = run_python([
+        '-m', 'pepubot', '--startup-report',
+        '-c', str(tmpdir.join('pepubot.conf')),
+    ], tmpdir)
+
+    last_line = output.splitlines()[-1]
+    assert last_line.startswith('total ')
+    total_ms = float(last_line.split()[1])
+    assert total_ms < STARTUP_BUDGET * 1000
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+import io
+import json
+import os
+import stat
+import sys
+import threading
+
+import pytest
+
+from .. import snapshot_file
+from .. import storage as storage_module
+from ..storage import Storage, convert_file, iter_file_versions
+from .conftest import run
+
+
+def reload(storage, **kwargs):
+    storage_module._load_cache.pop(storage.filename, None)
+    return Storage(
+        storage.filename,
+        file_format=kwargs.get('file_format', storage.file_format),
+        memory_limit=kwargs.get('memory_limit', storage.memory_limit))
+
+
+async def fill(storage, versions=5):
+    for n in range(versions):
+        await storage.store_item(
+            'box', f'version {n}\nline 2', add_new_version=True)
+    await storage.store_item('state', 'running')
+    await storage.store_item('state', 'picking_winner')
+
+
+@pytest.mark.parametrize('file_format', [
+    'json', 'compact-json', 'indexed', 'snapshot'])
+def test_store_and_load(tmpdir, file_format):
+    storage = Storage(str(tmpdir.join('data')), file_format=file_format)
+    run(fill(storage))
+
+    loaded = reload(storage)
+
+    assert run(loaded.get_item('box')) == 'version 4\nline 2'
+    assert run(loaded.get_item('state')) == 'picking_winner'
+    assert run(loaded.get_item('nonexisting')) is None
+    versions = run(loaded.get_all_versions('box'))
+    assert [list(x.value) for x in versions] == [
+        [f'version {n}', 'line 2'] for n in range(5)]
+    assert len(run(loaded.get_all_versions('state'))) == 1
+
+
+@pytest.mark.parametrize('file_format', [
+    'json', 'compact-json', 'indexed', 'snapshot'])
+def test_creates_locks_in_loop_thread(tmpdir, monkeypatch, file_format):
+    # On Python 3.7 asyncio.Lock binds to the event loop of the current
+    # thread, so it cannot be created in the executor threads
+    lock_class = asyncio.Lock
+
+    def create_lock(*args, **kwargs):
+        assert threading.current_thread() is threading.main_thread()
+        return lock_class(*args, **kwargs)
+
+    filename = str(tmpdir.join('data'))
+    run(fill(Storage(filename, file_format=file_format)))
+    monkeypatch.setattr(asyncio, 'Lock', create_lock)
+
+    loaded = reload(Storage(filename, file_format=file_format))
+    run(loaded.store_item('state', 'not_started'))
+    run(convert_file(filename, str(tmpdir.join('converted')), file_format))
+
+    assert run(loaded.get_item('state')) == 'not_started'
+
+
+def test_indexed_loads_only_latest_versions(tmpdir):
+    storage = Storage(str(tmpdir.join('data')), file_format='indexed')
+    run(fill(storage))
+
+    loaded = reload(storage)
+    data = run(loaded._get_data())
+
+    assert [x.value is not None for x in data.items['box']] == [
+        False, False, False, False, True]
+
+
+def test_indexed_evicts_cold_versions(tmpdir):
+    storage = Storage(str(tmpdir.join('data')), file_format='indexed')
+    run(fill(storage, versions=20))
+    loaded = reload(storage, memory_limit=100)
+
+    versions = run(loaded.get_all_versions('box'))
+
+    data = run(loaded._get_data())
+    assert len(versions) == 20
+    assert 0 < data.cold_size <= 100
+    assert data.items['box'][0].value is None
+    assert data.items['box'][-1].value is not None
+    assert [x.value[0] for x in run(loaded.get_all_versions('box'))] == [
+        f'version {n}' for n in range(20)]
+
+
+def test_converts_json_to_indexed(tmpdir):
+    filename = str(tmpdir.join('data'))
+    run(fill(Storage(filename, file_format='json')))
+    with open(filename, 'rt', encoding='utf-8') as fp:
+        json.load(fp)
+
+    indexed = reload(Storage(filename), file_format='indexed')
+    run(indexed.store_item('state', 'not_started'))
+    loaded = reload(indexed, file_format='json')
+
+    assert run(loaded.get_item('state')) == 'not_started'
+    assert len(run(loaded.get_all_versions('box'))) == 5
+    with open(filename, 'rb') as fp:
+        assert fp.read().startswith(b'PEPUBOT-INDEXED')
+
+
+@pytest.mark.parametrize('file_format', ['json', 'compact-json'])
+def test_json_formats(tmpdir, file_format):
+    storage = Storage(str(tmpdir.join('data')), file_format=file_format)
+    run(storage.store_item('state', 'running'))
+
+    with open(storage.filename, 'rt', encoding='utf-8') as fp:
+        contents = fp.read()
+
+    assert json.loads(contents)['state'][0][1] == ['running']
+    assert ('\n' in contents) is (file_format == 'json')
+    assert [x.basename for x in tmpdir.listdir()] == ['data']
+
+
+def test_file_mode(tmpdir):
+    storage = Storage(str(tmpdir.join('data')), file_format='json')
+    umask = os.umask(0)
+    os.umask(umask)
+
+    run(storage.store_item('state', 'running'))
+    created_mode = stat.S_IMODE(os.stat(storage.filename).st_mode)
+    os.chmod(storage.filename, 0o600)
+    run(storage.store_item('state', 'picking_winner'))
+    kept_mode = stat.S_IMODE(os.stat(storage.filename).st_mode)
+
+    assert created_mode == 0o666 & ~umask
+    assert kept_mode == 0o600
+
+
+@pytest.mark.parametrize('file_format', ['json', 'indexed', 'snapshot'])
+def test_convert_file(tmpdir, file_format):
+    source = str(tmpdir.join('source'))
+    target = str(tmpdir.join('target'))
+    run(fill(Storage(source, file_format='indexed')))
+
+    run(convert_file(source, target, file_format))
+    run(convert_file(source, source, 'snapshot'))
+
+    assert list(iter_file_versions(target)) == list(
+        iter_file_versions(source))
+    with open(source, 'rb') as fp:
+        assert fp.read().startswith(b'PEPUBOT-SNAPSHOT')
+
+
+@pytest.mark.parametrize('zstandard_installed', [True, False])
+def test_snapshot_roundtrip(zstandard_installed, monkeypatch):
+    if zstandard_installed:
+        pytest.importorskip('zstandard')
+    else:
+        monkeypatch.setitem(sys.modules, 'zstandard', None)
+    items = [
+        ('box', [(1, ['a', 'b']), (2, ['a', 'b', 'c']), (3, [])]),
+        ('state', [(4, [''])]), ('empty', []),
+        ('unicode', [(5, ['\u00e4\u00f6', '\U0001F37A'])]),
+    ]
+    fp = io.BytesIO()
+
+    snapshot_file.write(fp, items)
+
+    codec = fp.getvalue()[len(snapshot_file.MAGIC):][:4]
+    assert codec == (b'zstd' if zstandard_installed else b'gzip')
+    assert snapshot_file.read_all(fp.getvalue()) == items
+    fp.seek(0)
+    assert [(name, list(versions)) for (name, versions) in (
+        snapshot_file.read(fp))] == items
+
+
+def test_snapshot_detects_corruption():
+    fp = io.BytesIO()
+    snapshot_file.write(fp, [('box', [(1, ['a', 'b'])])])
+    data = bytearray(fp.getvalue())
+    data[len(snapshot_file.MAGIC) + 4] ^= 0xff  # Checksum in the header
+
+    with pytest.raises(ValueError, match='checksum'):
+        snapshot_file.read_all(bytes(data))
+
+
+def test_snapshot_rejects_lines_with_newlines():
+    with pytest.raises(ValueError):
+        snapshot_file.write(io.BytesIO(), [('box', [(1, ['a\nb'])])])
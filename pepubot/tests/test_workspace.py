@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# type: ignore
+
+import asyncio
+import os
+import signal
+import time
+
+import aiohttp
+import pytest
+
+from ..fake_slack import FakeSlackServer
+from ..settings import Settings, get_settings, use_workspace_settings
+from ..storage import get_default_storage
+from ..workspace import create_workspaces
+from .conftest import run
+
+
+def make_settings(tmpdir, **values):
+    env = dict({
+        'STORAGE_FILE': str(tmpdir.join('data.json')),
+        'QUEUE_SPILL_FILE': str(tmpdir.join('queue.jsonl')),
+        'DRUMROLL_DURATION': '0',
+    }, **values)
+    return Settings(str(tmpdir.join('nonexisting.conf')), env)
+
+
+def test_get_api_tokens(tmpdir):
+    assert make_settings(
+        tmpdir, SLACK_API_TOKEN='a').get_api_tokens() == ['a']
+    assert make_settings(
+        tmpdir, SLACK_API_TOKEN='a', SLACK_API_TOKENS='b, c,'
+    ).get_api_tokens() == ['b', 'c']
+    with pytest.raises(RuntimeError):
+        make_settings(tmpdir).get_api_tokens()
+
+
+def test_for_workspace(tmpdir):
+    settings = make_settings(tmpdir, SLACK_API_TOKENS='a,b')
+
+    result = settings.for_workspace('b', 'T123')
+
+    assert result.SLACK_API_TOKEN == 'b'
+    assert result.get_api_tokens() == ['b']
+    assert result.STORAGE_FILE == str(tmpdir.join('data-T123.json'))
+    assert result.QUEUE_SPILL_FILE == str(tmpdir.join('queue-T123.jsonl'))
+    assert result.TIMEZONE == settings.TIMEZONE
+    assert settings.STORAGE_FILE == str(tmpdir.join('data.json'))
+
+
+def test_workspace_settings_are_isolated(tmpdir):
+    settings = make_settings(tmpdir, SLACK_API_TOKENS='a,b')
+    settings_a = settings.for_workspace('a', 'TA')
+    settings_b = settings.for_workspace('b', 'TB')
+
+    async def get_in_workspace(workspace_settings):
+        use_workspace_settings(workspace_settings)
+        await asyncio.sleep(0)
+        return (get_settings(), get_default_storage())
+
+    async def get_in_both():
+        return await asyncio.gather(
+            get_in_workspace(settings_a), get_in_workspace(settings_b))
+
+    ((got_a, storage_a), (got_b, storage_b)) = run(get_in_both())
+
+    assert got_a is settings_a
+    assert got_b is settings_b
+    assert storage_a.filename == settings_a.STORAGE_FILE
+    assert storage_b.filename == settings_b.STORAGE_FILE
+
+
+def test_serving_two_workspaces(tmpdir):
+    run(_serve_two_workspaces(tmpdir))
+
+
+async def _serve_two_workspaces(tmpdir):
+    server = FakeSlackServer()
+    await server.start()
+    settings = make_settings(
+        tmpdir, SLACK_API_TOKENS='xoxb-a,xoxb-b', SLACK_API_URL=server.url)
+    (team_a, team_b) = [server.get_team_id(x) for x in ['xoxb-a', 'xoxb-b']]
+    session = aiohttp.ClientSession()
+    workspaces = await create_workspaces(settings, session)
+    futures = [x.start() for x in workspaces]
+    try:
+        await server.wait_for(lambda x: len(x._websockets) == 2, 10)
+        await server.send_event({
+            'type': 'message', 'channel': 'CPEPU', 'user': 'U1',
+            'ts': f'{time.time():.6f}', 'text': 'pepu open'}, team_a)
+        await server.wait_for(lambda x: any(
+            y['text'].startswith('PePu is on!') for y in x.messages), 10)
+    finally:
+        for workspace in workspaces:
+            workspace.stop()
+        await asyncio.gather(*futures, return_exceptions=True)
+        for workspace in workspaces:
+            await workspace.drain()
+        await session.close()
+        await server.stop()
+        for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+            asyncio.get_event_loop().remove_signal_handler(signum)
+
+    assert [x.settings.STORAGE_FILE for x in workspaces] == [
+        str(tmpdir.join(f'data-{team_a}.json')),
+        str(tmpdir.join(f'data-{team_b}.json'))]
+    assert [x['team_id'] for x in server.messages] == [team_a]
+    assert os.path.exists(workspaces[0].settings.STORAGE_FILE)
+    assert not os.path.exists(workspaces[1].settings.STORAGE_FILE)
@@ -1,15 +1,31 @@
 from datetime import datetime, timezone, tzinfo
+from functools import lru_cache
 from typing import Callable
 
-import pytz
-
 from .settings import get_settings
 
 
 def get_default_timezone() -> tzinfo:
-    return pytz.timezone(get_settings().TIMEZONE)
+    return _get_timezone(get_settings().TIMEZONE)
+
+
+@lru_cache(maxsize=None)
+def _get_timezone(name: str) -> tzinfo:
+    import pytz  # Deferred, since loading the zone database is slow
+    return pytz.timezone(name)
 
 
 def now(_get_tz: Callable[[], tzinfo] = get_default_timezone) -> datetime:
     utcnow = datetime.utcnow().replace(tzinfo=timezone.utc)
     return utcnow.astimezone(_get_tz())
+
+
+def make_aware(value: datetime) -> datetime:
+    """
+    Make given datetime aware, interpreting naive ones in default timezone.
+    """
+    if value.tzinfo is not None:
+        return value
+    tz = get_default_timezone()
+    localize = getattr(tz, 'localize', None)  # pytz needs localize
+    return localize(value) if localize else value.replace(tzinfo=tz)
@@ -1,13 +1,15 @@
-from typing import Any, Dict
+from typing import TYPE_CHECKING, Any, Dict
 
-import slack
+if TYPE_CHECKING:
+    import slack
 
 UserInfoDict = Dict[str, Any]
 
-_userinfo_cache: Dict[str, UserInfoDict] = {}
 
-
-async def get_username(slack_client: slack.WebClient, user_id: str) -> str:
+async def get_username(
+        slack_client: 'slack.WebClient',
+        user_id: str,
+) -> str:
     userinfo = await _get_userinfo(slack_client, user_id)
     username = userinfo.get('name')
     if not isinstance(username, str):
@@ -17,14 +19,12 @@ async def get_username(slack_client: slack.WebClient, user_id: str) -> str:
 
 
 async def _get_userinfo(
-        slack_client: slack.WebClient,
+        slack_client: 'slack.WebClient',
         user_id: str,
 ) -> UserInfoDict:
-    userinfo = _userinfo_cache.get(user_id)
-    if userinfo is None:
-        response = await slack_client.users_info(user=user_id)
-        userinfo = response.data.get('user')
-        if not isinstance(userinfo, dict):
-            raise RuntimeError('Slack returned invalid userinfo response')
-        _userinfo_cache[user_id] = userinfo
+    # Caching is done by the client, see CachingWebClient
+    response = await slack_client.users_info(user=user_id)
+    userinfo = response.data.get('user')
+    if not isinstance(userinfo, dict):
+        raise RuntimeError('Slack returned invalid userinfo response')
     return userinfo
@@ -0,0 +1,134 @@
+"""
+Slack workspaces served by the process.
+
+Each workspace has settings, storage, event queue and Slack clients of
+its own, but all workspaces share the event loop and the HTTP
+connection pool.  The workspace settings are activated in the context
+of the tasks of the workspace, so that `get_settings` and
+`get_default_storage` return the right objects for the workspace.
+"""
+import asyncio
+import contextvars
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional
+
+from .caching_client import CachingWebClient
+from .ingestion import EventQueue, create_event_queue
+from .runner import PePuRunner
+from .settings import Settings, use_workspace_settings
+
+if TYPE_CHECKING:
+    import aiohttp
+    import slack
+
+LOG = logging.getLogger(__name__)
+
+_workspaces: Dict[int, 'Workspace'] = {}  # id of RTM client -> workspace
+
+
+async def create_http_session() -> 'aiohttp.ClientSession':
+    """
+    Create the HTTP session shared by the Web API clients of all workspaces.
+    """
+    import aiohttp
+
+    return aiohttp.ClientSession()
+
+
+async def create_workspaces(
+        settings: Settings,
+        session: 'aiohttp.ClientSession',
+) -> List['Workspace']:
+    """
+    Create a workspace for each configured Slack API token.
+
+    With a single token the settings are used as is.  With several
+    tokens, the team id of each token is used to separate the files of
+    the workspaces.
+    """
+    tokens = settings.get_api_tokens()
+    if len(tokens) == 1 and not settings.SLACK_API_TOKENS:
+        return [Workspace(settings, session)]
+    from .slack import get_web_client
+
+    use_workspace_settings(settings)  # Only in the context of this task
+    workspaces = []
+    for token in tokens:
+        client = get_web_client(session=session, token=token)
+        response = await client.auth_test()
+        team_id = response.data['team_id']
+        LOG.info('Serving workspace %s (%s)', team_id, response.data.get(
+            'team', ''))
+        workspaces.append(
+            Workspace(settings.for_workspace(token, team_id), session))
+    return workspaces
+
+
+class Workspace:
+    def __init__(
+            self,
+            settings: Settings,
+            session: Optional['aiohttp.ClientSession'] = None,
+    ) -> None:
+        self.settings = settings
+        self.session = session
+        self.rtm_client: Optional['slack.RTMClient'] = None
+        self.web_client: Optional[CachingWebClient] = None
+        self.event_queue: Optional[EventQueue] = None
+
+    def start(self) -> 'asyncio.Future[Any]':
+        """
+        Start the RTM session of the workspace in a context of its own.
+        """
+        return contextvars.copy_context().run(self._start)
+
+    def _start(self) -> 'asyncio.Future[Any]':
+        rtm_client = self._set_up()
+        future: 'asyncio.Future[Any]' = rtm_client.start()
+        return future
+
+    def _set_up(self) -> 'slack.RTMClient':
+        """
+        Set up the clients and the event queue without connecting to Slack.
+        """
+        from .slack import get_rtm_client, get_web_client
+
+        use_workspace_settings(self.settings)
+        self.rtm_client = rtm_client = get_rtm_client()
+        # Callbacks are stored to the class and a callback given in a
+        # list is not added again if already there
+        self.rtm_client.on(event='message', callback=[handle_new_message])
+        _workspaces[id(self.rtm_client)] = self
+        web_client = CachingWebClient(get_web_client(session=self.session))
+        self.web_client = web_client
+        self.event_queue = create_event_queue(
+            handler=(lambda x: PePuRunner(web_client).feed_message(x)),
+            is_ignorable=PePuRunner(web_client).is_ignorable_event)
+        return rtm_client
+
+    def stop(self) -> None:
+        if self.rtm_client:
+            self.rtm_client.stop()
+
+    async def drain(self) -> None:
+        if self.event_queue:
+            LOG.info('Handling the queued events: %s', (
+                self.event_queue.get_stats()))
+            await self.event_queue.drain()
+        if self.web_client:
+            LOG.info('Slack API cache statistics: %s', ', '.join(
+                f'{method}: {stats}' for (method, stats) in sorted(
+                    self.web_client.get_stats().items())))
+
+
+async def handle_new_message(
+        *,
+        rtm_client: 'slack.RTMClient',
+        data: Mapping[str, Any],
+        **kwargs: object,
+) -> None:
+    # The callbacks are registered to the RTMClient class, so find out
+    # the workspace from the client which received the event
+    workspace = _workspaces[id(rtm_client)]
+    assert workspace.event_queue
+    await workspace.event_queue.put(data)